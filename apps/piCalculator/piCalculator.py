@@ -3,21 +3,32 @@
 import argparse
 import json
 import logging
+import math
 import os
 import queue
 import random
 import redis
 import rpyc
 import secrets
+import sys
 import time
 from ctypes import c_int
-
-from multiprocessing import Process, Lock, Value
+from functools import partial
 
 from cluster import (
     Cluster,
-    Worker
+    Journal,
+    Progress,
+    ConnectionManager,
+    Scheduler,
+    Worker,
+    startup_workers
+)
+from cluster.scheduler import (
+    GapCursor,
+    async_method
 )
+from cluster.tuner import DEFAULT_TARGET_DURATION
 
 
 DEFAULT_MAX_NUMBER = 400000000
@@ -27,64 +38,128 @@ DEFAULT_BLOCK_COUNT = 100000
 DEFAULT_NODE_COUNT = 0
 DEFAULT_START_NODE = 1
 
-CPU_COUNT_FACTOR = 4
+# number of samples drawn from each random stream, blocks are sized in multiples of this
+SEED_UNIT_SIZE = 0x10000
+
+DEFAULT_CONFIDENCE = 0.95
+# fewest samples to take before the precision of the estimate is trusted
+MIN_PRECISION_SAMPLES = SEED_UNIT_SIZE * 16
+
+# ways of choosing the sample points, the low discrepancy sequences are split into disjoint index ranges
+SAMPLE_RANDOM = 'random'
+SAMPLE_HALTON = 'halton'
+SAMPLE_SOBOL = 'sobol'
+SAMPLE_ENGINES = [SAMPLE_RANDOM, SAMPLE_HALTON, SAMPLE_SOBOL]
+# most points the workers can draw from the sobol sequence
+SOBOL_MAX_NUMBER = 1 << 32
+DEFAULT_SAMPLE_ENGINE = SAMPLE_RANDOM
 
 CLUSTER_CONFIG_FILENAME = 'cluster.conf'
+DEFAULT_JOURNAL_FILENAME = 'piCalculator.journal'
 WORKER_PATH = os.path.join(os.path.dirname(__file__), 'worker')
 WORKER_PORT = 18883
 WORKER_APP_NAME = 'pi_calculate.py'
 
 logger = logging.getLogger(__name__)
 
-def worker_thread(worker, block_count, count, total, max_total):
-    connection = worker.connect(config={
-        'sync_request_timeout': 60
-    })
-    # print(f'connected to {worker.node.name}')
-    is_done = False
-    while not is_done:
-        value = connection.root.calculate(block_count)
-        count.value = count.value + value
-        total.value = total.value + block_count
-        # print(count.value, total.value)
-        is_done = total.value >= max_total.value
-                
-
-    connection.close()
-    # print(f'finished {worker.node.name}')
-
-def node_thread(node, is_restart, block_count, count, total, max_total):
-    proc_list = []
-    worker = Worker(node, WORKER_PATH, WORKER_APP_NAME, WORKER_PORT )
-    connection = worker.startup(is_restart)
-    if not connection:
-        print(f'cannot connect to node {node.name}')
-        return
-    cpu_count = connection.root.get_cpu_count()
-    connection.close()
-    # print(f'start {worker.node.name} {cpu_count}')
-    for index in range(cpu_count * CPU_COUNT_FACTOR):
-        proc = Process(target=worker_thread, args=(worker, block_count, count, total, max_total))
-        proc_list.append(proc)
-        proc.start()
-
-    for proc in proc_list:
-        proc.join()
-
-    # print(f'end node thread {node.name}')
-
-def is_proc_alive(proc_list):
-    for proc in proc_list:
-        if proc.is_alive():
-            return True
-    return False
+def calculate_block(sample, seed, connection, items):
+    if sample == SAMPLE_RANDOM:
+        return connection.root.calculate_range(seed, items[0], items[1], SEED_UNIT_SIZE)
+    return connection.root.calculate_qmc(sample, seed, items[0], items[1], SEED_UNIT_SIZE)
+
+def calculate_block_async(sample, seed, connection, items):
+    if sample == SAMPLE_RANDOM:
+        return async_method(connection, 'calculate_range')(seed, items[0], items[1], SEED_UNIT_SIZE)
+    return async_method(connection, 'calculate_qmc')(sample, seed, items[0], items[1], SEED_UNIT_SIZE)
+
+def reduce_block(journal, value, items, count):
+    journal.record(items, count)
+    return (value[0] + count, value[1] + items[1] - items[0])
+
+def merge_counts(value, other):
+    return (value[0] + other[0], value[1] + other[1])
+
+def z_score(confidence):
+    """
+    Return the number of standard deviations either side of the mean that holds `confidence` of a normal distribution.
+    """
+    low, high = 0.0, 10.0
+    for index in range(64):
+        middle = (low + high) / 2
+        if math.erf(middle / math.sqrt(2)) < confidence:
+            low = middle
+        else:
+            high = middle
+    return high
+
+def pi_half_width(count, total, z):
+    """
+    Return the half width of the confidence interval of the pi estimate 4 * count / total.
+    Each sample is a hit with probability p, so the estimate has a variance of 16 * p * (1 - p) / total.
+    """
+    if not total:
+        return math.inf
+    p = count / total
+    return z * math.sqrt(16 * p * (1 - p) / total)
+
+def get_engine_nodes(manager, worker_list):
+    engine_nodes = {}
+    for worker in worker_list:
+        with manager.borrow(worker) as connection:
+            engine = connection.root.get_engine()
+        engine_nodes.setdefault(engine, []).append(worker.node.name)
+    return engine_nodes
+
+def get_unsupported_nodes(manager, worker_list, sample):
+    node_names = []
+    for worker in worker_list:
+        with manager.borrow(worker) as connection:
+            try:
+                sample_engines = connection.root.get_sample_engines()
+            except AttributeError:
+                sample_engines = [SAMPLE_RANDOM]
+        if sample not in sample_engines:
+            node_names.append(worker.node.name)
+    return node_names
 
 def main():
     parser = argparse.ArgumentParser(description='PI Calculator')
 
     parser.add_argument('-b', '--block-count',
         default=DEFAULT_BLOCK_COUNT,
-        help=f'Number of numbers to send to each node. Default: {DEFAULT_BLOCK_COUNT}'
+        help=f'Number of numbers to send to each node to start with. Default: {DEFAULT_BLOCK_COUNT}'
+    )
+
+    parser.add_argument('-t', '--target-duration',
+        default=DEFAULT_TARGET_DURATION,
+        help=f'Seconds each block should take, 0 to keep the block count fixed. Default: {DEFAULT_TARGET_DURATION}'
+    )
+
+    parser.add_argument('-e', '--engine',
+        choices=SAMPLE_ENGINES,
+        default=DEFAULT_SAMPLE_ENGINE,
+        help='How to choose the sample points, random or from the halton or scrambled sobol (needs scipy) '
+            f'low discrepancy sequence. Default: {DEFAULT_SAMPLE_ENGINE}'
+    )
+
+    parser.add_argument('-p', '--precision',
+        help='Stop once the pi estimate is within this of the true value at the given confidence, '
+            'with --max as the most samples to take. The interval is for random samples, so it is '
+            'a loose bound for the other engines. Default: run to --max'
+    )
+
+    parser.add_argument('--confidence',
+        default=DEFAULT_CONFIDENCE,
+        help=f'Confidence of the --precision interval. Default: {DEFAULT_CONFIDENCE}'
+    )
+
+    parser.add_argument('--seed',
+        help='Seed for the random streams, a run with the same seed and max gives the same result. Default: random'
+    )
+
+    parser.add_argument('--no-pipeline',
+        action='store_true',
+        help='Send each block in flight over a connection of its own, instead of pipelining blocks over one connection per node. Default: False'
     )
 
     parser.add_argument('-d', '--debug',
@@ -97,12 +172,11 @@ def main():
         help=f'Max number to calculate. Default: {DEFAULT_MAX_NUMBER}'
     )
 
-    if os.environ.get('CLUSTER_CONF', None):
-        CLUSTER_CONFIG_FILENAME = os.environ.get('CLUSTER_CONF')
+    cluster_config_filename = os.environ.get('CLUSTER_CONF', CLUSTER_CONFIG_FILENAME)
 
     parser.add_argument('--cluster',
-        default=CLUSTER_CONFIG_FILENAME,
-        help=f'Config cluster file. Default: {CLUSTER_CONFIG_FILENAME}'
+        default=cluster_config_filename,
+        help=f'Config cluster file. Default: {cluster_config_filename}'
     )
 
     parser.add_argument('--count',
@@ -115,11 +189,26 @@ def main():
         help=f'Node index to start with. Default: {DEFAULT_START_NODE}'
     )
 
+    parser.add_argument('--profile',
+        action='store_true',
+        help='calibrate the speed of each node again. Default: False'
+    )
+
     parser.add_argument('--restart',
         action='store_true',
         help='force restart of worker servers. Default: False'
     )
 
+    parser.add_argument('--journal',
+        default=DEFAULT_JOURNAL_FILENAME,
+        help=f'File to record the finished blocks in, so that the run can be resumed. Default: {DEFAULT_JOURNAL_FILENAME}'
+    )
+
+    parser.add_argument('--resume',
+        action='store_true',
+        help='Carry on the run recorded in the journal, and only send out the blocks it does not have. Default: False'
+    )
+
     args = parser.parse_args()
 
     if args.debug:
@@ -135,48 +224,120 @@ def main():
     if args.restart:
         print('will restart workers')
 
-    proc_list = []
+    worker_list = []
     max_number = int(args.max)
     max_node_count = int(args.count)
     node_count = 0
     node_index = 1
-    current_number = 0
-    block_count = args.block_count
+    block_count = int(args.block_count)
+    target_duration = float(args.target_duration) or None
+    seed = int(args.seed) if args.seed else None
+    precision = float(args.precision) if args.precision else None
+    if args.engine == SAMPLE_SOBOL and max_number > SOBOL_MAX_NUMBER:
+        print(f'the sobol engine can take at most {SOBOL_MAX_NUMBER} samples')
+        return
+    z = z_score(float(args.confidence))
     start_time = time.time()
-    count = Value('d', 0)
-    total = Value('d', 0)
-    max_total = Value('d', max_number)
-    lock = Lock()
+
+    journal = Journal(args.journal)
+    header = {
+        'app': 'pi',
+        'max': max_number,
+        'seed': seed,
+        'engine': args.engine,
+        'unit_size': SEED_UNIT_SIZE,
+    }
+    if not args.resume and seed is None:
+        header['seed'] = secrets.randbits(63)
+    try:
+        header, done_ranges, done_count = journal.open(header, args.resume)
+    except ValueError as e:
+        print(e)
+        return
+    seed = header['seed']
+    done_value = (done_count, done_ranges.size)
+    if args.resume:
+        print(f'resuming {done_value[1]} samples from {args.journal}')
 
     for node in cluster.nodes:
         if node_index >= int(args.start):
-            proc = Process(target=node_thread, args=(node, args.restart, block_count, count, total, max_total))
-            proc_list.append(proc)
-            proc.start()
+            worker_list.append(Worker(node, WORKER_PATH, WORKER_APP_NAME, WORKER_PORT))
             node_count += 1
             if node_count >= max_node_count and max_node_count > 0:
                 break
         node_index += 1
 
-    if len(proc_list) == 0:
+    is_stopped = False
+
+    def check_precision(progress):
+        # called by the progress reader after each block, so that the run stops as soon as it can
+        nonlocal is_stopped
+        count, total = merge_counts(done_value, (
+            sum(value[0] for value in scheduler.partials),
+            sum(value[1] for value in scheduler.partials)
+        ))
+        if not is_stopped and total >= MIN_PRECISION_SAMPLES and pi_half_width(count, total, z) <= precision:
+            # the blocks already running are still counted
+            scheduler.stop()
+            is_stopped = True
+
+    progress = Progress(max_number, done_value[1], on_event=check_precision if precision else None)
+    manager = ConnectionManager(config={
+        'sync_request_timeout': 60
+    })
+    scheduler = Scheduler(
+        manager,
+        partial(calculate_block if args.no_pipeline else calculate_block_async, args.engine, seed),
+        partial(reduce_block, journal),
+        block_size=block_count,
+        target_duration=target_duration,
+        granularity=SEED_UNIT_SIZE,
+        pipeline=not args.no_pipeline,
+        partial=lambda: (0, 0),
+        merge=merge_counts,
+        progress=progress
+    )
+    connection_list = startup_workers(worker_list, args.restart, config=manager.config)
+    for worker in scheduler.add_workers(worker_list, connection_list, args.profile):
+        print(f'cannot connect to node {worker.node.name}')
+
+    if len(scheduler.workers) == 0:
         print('Cannot connect to any workers')
         return
 
-    while is_proc_alive(proc_list):
-        if total.value:
-            percent_done = (total.value / max_total.value) * 100
-            print(f'\r{percent_done:0.1f}%', end='', flush=True)
-        time.sleep(1)
+    engine_nodes = get_engine_nodes(manager, scheduler.workers)
+    node_names = get_unsupported_nodes(manager, scheduler.workers, args.engine)
+    if node_names:
+        print(f'{args.engine} engine is not supported on {", ".join(node_names)}')
+        manager.close_all()
+        return
+
+    progress.start()
+    scheduler.start(GapCursor(0, max_number, done_ranges))
+    scheduler.join()
+    progress.close()
 
-    for proc in proc_list:
-       proc.join()
+    manager.close_all()
+    journal.close()
 
-    pi = (4.0 * count.value) / total.value
+    count, total = merge_counts(done_value, scheduler.result())
+    if total != max_number and not is_stopped:
+        print(f'\rOnly {total} of {max_number} numbers were completed, run again with --resume to finish')
+        return 1
+    pi = (4.0 * count) / total
+    half_width = pi_half_width(count, total, z)
 
 
     done_time = time.time() - start_time
     print(f'\rFound {pi} numbers completed time {done_time:0.2f} seconds')
+    print(f'{progress.summary()}')
+    print(f'{total} samples, pi within {half_width:0.2g} at {float(args.confidence):0.0%} confidence')
+    if precision and not is_stopped:
+        print(f'precision {precision} not reached within {max_number} samples')
+    print(f'seed {seed} {args.engine} samples')
+    for engine, node_names in engine_nodes.items():
+        print(f'{engine} engine on {", ".join(node_names)}')
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,35 +1,327 @@
 #!/usr/bin/env  python3
 
+import argparse
 import cpuinfo
-import math
+import os
 import random
 import rpyc
+import sys
+import time
 
+from multiprocessing import Pool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from scipy.stats import qmc
+except ImportError:
+    qmc = None
+
+WORKER_READY_TOKEN = 'worker ready'
 WORKER_PORT = 18883
 
+# number of points to generate at a time, so that a large block does not need one huge array
+CHUNK_SIZE = 0x100000
+# smallest number of points worth sending to another process
+MIN_SPLIT_SIZE = 10000
 
-class PICalculatorWorker(rpyc.Service):
+# process pool with one process per core, started before the server
+process_pool = None
 
-    def exposed_calculate(self, size):
+ENGINE_NUMPY = 'numpy'
+ENGINE_PYTHON = 'python'
+
+# ways of choosing the sample points
+SAMPLE_RANDOM = 'random'
+SAMPLE_HALTON = 'halton'
+SAMPLE_SOBOL = 'sobol'
+HALTON_BASES = (2, 3)
+# bits of the sobol direction numbers, scipy's default of 30 only gives 2**30 points, and it cannot
+# fast forward a sampler with more than 32, so the controller keeps the samples below 2**32
+SOBOL_BITS = 32
+# size of the table of radical inverses, the digits of each index are looked up this many at a time
+HALTON_TABLE_SIZE = 0x10000
+
+# radical inverse tables for each base, made the first time they are needed
+halton_tables = {}
+
+
+def split_size(size, count):
+    part_size = max(MIN_SPLIT_SIZE, -(-size // count))
+    return [min(part_size, size - start) for start in range(0, size, part_size)]
+
+
+def init_process():
+    # each forked process starts with the same random state, so seed each one on its own
+    random.seed()
+
+
+def split_units(from_index, to_index, unit_size, count):
+    unit_count = -(-(to_index - from_index) // unit_size)
+    part_size = max(1, -(-unit_count // count)) * unit_size
+    return [(start, min(start + part_size, to_index)) for start in range(from_index, to_index, part_size)]
+
+
+def calculate(size):
+    if numpy:
+        return calculate_numpy(size)
+    return calculate_python(size)
+
+
+def seeded_generator(seed, unit):
+    """
+    Return the random generator for one unit of points. With numpy this is the counter based
+    Philox generator, keyed from the job seed and the unit index.
+    """
+    if numpy:
+        return numpy.random.Generator(numpy.random.Philox(numpy.random.SeedSequence([seed, unit])))
+    return random.Random((seed << 64) | unit)
+
+
+def calculate_units(items):
+    """
+    Count the hits for the points from_index to to_index, where each unit of `unit_size` points
+    has a random stream of its own. So the result only depends on the seed and the range, and
+    not on how the range was split up.
+    """
+    seed, from_index, to_index, unit_size = items
+    if from_index % unit_size:
+        raise ValueError(f'range start {from_index} is not a multiple of the unit size {unit_size}')
+    result = 0
+    for unit_start in range(from_index, to_index, unit_size):
+        generator = seeded_generator(seed, unit_start // unit_size)
+        size = min(unit_size, to_index - unit_start)
+        if numpy:
+            result += calculate_numpy(size, generator)
+        else:
+            result += calculate_python(size, generator)
+    return result
+
+
+def sample_engines():
+    engine_list = [SAMPLE_RANDOM, SAMPLE_HALTON]
+    if qmc and numpy:
+        engine_list.append(SAMPLE_SOBOL)
+    return engine_list
+
+
+def calculate_qmc_units(items):
+    """
+    Count the hits for the points from_index to to_index of one low discrepancy sequence, so that
+    the nodes working on different ranges cover one point set between them.
+    """
+    engine, seed, from_index, to_index = items
+    if engine == SAMPLE_HALTON:
+        return calculate_halton(seed, from_index, to_index)
+    if engine == SAMPLE_SOBOL:
+        return calculate_sobol(seed, from_index, to_index)
+    raise ValueError(f'unknown sample engine {engine}')
+
+
+def halton_shift(seed):
+    """
+    Return the random shift added to each Halton point, taken from the seed the same way
+    with or without numpy, so that all of the nodes use the same shifted point set.
+    """
+    generator = random.Random(seed)
+    return [generator.random() for base in HALTON_BASES]
+
+
+def radical_inverse(index, base):
+    result = 0.0
+    factor = 1.0 / base
+    while index:
+        index, digit = divmod(index, base)
+        result += digit * factor
+        factor /= base
+    return result
+
+
+def calculate_halton(seed, from_index, to_index):
+    shift_x, shift_y = halton_shift(seed)
+    if not numpy:
         result = 0
-        for index in range(size):
-            # x = random.uniform (-1.0, 1.0)
-            # y = random.uniform (-1.0, 1.0)
-            # distance = math.hypot(x, y)
-            x = random.random()
-            y = random.random()
-            distance = math.sqrt(x**2 + y**2)
-            if distance < 1.0:
+        for index in range(from_index + 1, to_index + 1):
+            x = (radical_inverse(index, HALTON_BASES[0]) + shift_x) % 1.0
+            y = (radical_inverse(index, HALTON_BASES[1]) + shift_y) % 1.0
+            if x * x + y * y < 1.0:
                 result += 1
         return result
 
+    result = 0
+    # index 0 is the point (0, 0) in every base, so the sequence starts at 1
+    for start in range(from_index + 1, to_index + 1, CHUNK_SIZE):
+        indexes = numpy.arange(start, min(start + CHUNK_SIZE, to_index + 1), dtype=numpy.int64)
+        x = halton_numpy(indexes, HALTON_BASES[0], shift_x)
+        y = halton_numpy(indexes, HALTON_BASES[1], shift_y)
+        numpy.multiply(x, x, out=x)
+        numpy.multiply(y, y, out=y)
+        numpy.add(x, y, out=x)
+        result += int(numpy.count_nonzero(x < 1.0))
+    return result
+
+
+def halton_table(base):
+    """
+    Return the radical inverse of each number below the largest power of `base` that fits in the table.
+    """
+    if base not in halton_tables:
+        size = base
+        while size * base <= HALTON_TABLE_SIZE:
+            size *= base
+        table = numpy.zeros(size)
+        value = numpy.arange(size)
+        factor = 1.0 / base
+        while value.any():
+            table += (value % base) * factor
+            value //= base
+            factor /= base
+        halton_tables[base] = table
+    return halton_tables[base]
+
+
+def halton_numpy(indexes, base, shift):
+    table = halton_table(base)
+    table_size = len(table)
+    result = numpy.full(len(indexes), shift)
+    value = indexes
+    factor = 1.0
+    # the indexes are in order, so the last one has the most digits
+    while value[-1]:
+        value, digits = numpy.divmod(value, table_size)
+        result += table[digits] * factor
+        factor /= table_size
+    numpy.remainder(result, 1.0, out=result)
+    return result
+
+
+def calculate_sobol(seed, from_index, to_index):
+    if not (qmc and numpy):
+        raise ValueError('the sobol sample engine needs scipy')
+    # the same seed gives the same scrambled sequence on every node
+    sampler = qmc.Sobol(d=2, scramble=True, bits=SOBOL_BITS, seed=seed)
+    if from_index > 0:
+        # scipy cannot fast forward a new sampler by 0
+        sampler.fast_forward(from_index)
+    result = 0
+    remaining = to_index - from_index
+    while remaining > 0:
+        count = min(remaining, CHUNK_SIZE)
+        points = sampler.random(count)
+        numpy.multiply(points, points, out=points)
+        result += int(numpy.count_nonzero(points.sum(axis=1) < 1.0))
+        remaining -= count
+    return result
+
+
+def calculate_numpy(size, generator=None):
+    if generator is None:
+        generator = numpy.random.default_rng()
+    result = 0
+    remaining = size
+    while remaining > 0:
+        count = min(remaining, CHUNK_SIZE)
+        x = generator.random(count)
+        y = generator.random(count)
+        # x*x + y*y < 1 is the same as distance < 1, without the sqrt
+        numpy.multiply(x, x, out=x)
+        numpy.multiply(y, y, out=y)
+        numpy.add(x, y, out=x)
+        result += int(numpy.count_nonzero(x < 1.0))
+        remaining -= count
+    return result
+
+
+def calculate_python(size, generator=random):
+    result = 0
+    for index in range(size):
+        x = generator.random()
+        y = generator.random()
+        if x * x + y * y < 1.0:
+            result += 1
+    return result
+
+
+class PICalculatorWorker(rpyc.Service):
+    ALIASES = ['pi_calculate']
+
+
+    def exposed_calculate(self, size):
+        # split the points over the process pool, one part for each core
+        size_list = split_size(size, os.cpu_count())
+        if process_pool is None or len(size_list) < 2:
+            return calculate(size)
+        return sum(process_pool.imap_unordered(calculate, size_list))
+
+    def exposed_calculate_range(self, seed, from_index, to_index, unit_size):
+        # split the units over the process pool, one part for each core
+        item_list = [
+            (seed, start, stop, unit_size)
+            for start, stop in split_units(from_index, to_index, unit_size, os.cpu_count())
+        ]
+        if process_pool is None or len(item_list) < 2:
+            return calculate_units((seed, from_index, to_index, unit_size))
+        return sum(process_pool.imap_unordered(calculate_units, item_list))
+
+    def exposed_calculate_qmc(self, engine, seed, from_index, to_index, unit_size):
+        # each part of the range is a part of the same sequence, so the parts can go to any process
+        item_list = [
+            (engine, seed, start, stop)
+            for start, stop in split_units(from_index, to_index, unit_size, os.cpu_count())
+        ]
+        if process_pool is None or len(item_list) < 2:
+            return calculate_qmc_units((engine, seed, from_index, to_index))
+        return sum(process_pool.imap_unordered(calculate_qmc_units, item_list))
+
+    def exposed_get_sample_engines(self):
+        return sample_engines()
+
+    def exposed_get_engine(self):
+        return ENGINE_NUMPY if numpy else ENGINE_PYTHON
+
     def exposed_get_cpu_count(self):
         info = cpuinfo.get_cpu_info()
         return info['count']        
 
+    def exposed_get_cpu_info(self):
+        info = cpuinfo.get_cpu_info()
+        hz_actual = info.get('hz_actual', [0, 0])[0]
+        return (info.get('arch'), info.get('count'), hz_actual)
+
+    def exposed_calibrate(self, loop_count):
+        start_time = time.perf_counter()
+        value = 0
+        for index in range(loop_count):
+            value = (value * 31 + index) % 1000003
+        return time.perf_counter() - start_time
+
 def main():
-    from rpyc.utils.server import ForkingServer
-    server = ForkingServer(PICalculatorWorker, port=WORKER_PORT)
+    from rpyc.utils.server import ThreadedServer
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port',
+        type=int,
+        default=WORKER_PORT,
+        help=f'Port to listen on. Default: {WORKER_PORT}'
+    )
+    args = parser.parse_args()
+
+    global process_pool
+    process_pool = Pool(os.cpu_count(), init_process)
+
+    server = ThreadedServer(PICalculatorWorker, port=args.port)
+    # listen before telling the controller that the server is ready
+    server._listen()
+    try:
+        print(WORKER_READY_TOKEN, flush=True)
+    except BrokenPipeError:
+        # the controller connected before it read the token, and has closed the pipe
+        pass
+    # nothing reads the output after this, so do not write to a closed pipe
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
     server.start()
 
 
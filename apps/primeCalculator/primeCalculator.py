@@ -4,19 +4,38 @@ import argparse
 import json
 import logging
 import os
-import queue
 import random
-import redis
 import rpyc
 import secrets
+import sys
 import time
 from ctypes import c_int
-
-from multiprocessing import Process, Queue, Pool, Array, Lock
+from functools import partial
 
 from cluster import (
     Cluster,
-    Worker
+    Journal,
+    Progress,
+    ConnectionManager,
+    Scheduler,
+    Worker,
+    startup_workers
+)
+from cluster.scheduler import GapCursor
+from cluster.tuner import DEFAULT_TARGET_DURATION
+from result_sink import (
+    DEFAULT_BITMAP_FILENAME,
+    ENCODING_BITMAP,
+    ENCODING_SET,
+    SINK_COUNT,
+    SINK_FILE,
+    SINK_MEMORY,
+    SINK_NAMES,
+    SINK_REDIS,
+    FileSink,
+    MemorySink,
+    RedisSink,
+    ResultSink
 )
 
 
@@ -27,9 +46,12 @@ DEFAULT_BLOCK_COUNT = 10000
 DEFAULT_NODE_COUNT = 0
 DEFAULT_START_NODE = 1
 
-CPU_COUNT_FACTOR = 4
+ENGINE_SIEVE = 'sieve'
+ENGINE_TRIAL = 'trial'
+DEFAULT_ENGINE = ENGINE_SIEVE
 
 CLUSTER_CONFIG_FILENAME = 'cluster.conf'
+DEFAULT_JOURNAL_FILENAME = 'primeCalculator.journal'
 WORKER_PATH = os.path.join(os.path.dirname(__file__), 'worker')
 WORKER_PORT = 18882
 WORKER_APP_NAME = 'prime_calculate.py'
@@ -38,61 +60,71 @@ REDIS_CONNECT = {
     'port': 6379, 
     'db': 1
 }
-REDIS_DATA_NAME= 'prime'
+DEFAULT_REDIS = f'{REDIS_CONNECT["host"]}:{REDIS_CONNECT["port"]}/{REDIS_CONNECT["db"]}'
+DEFAULT_REDIS_BATCH_SIZE = 10000
+DEFAULT_ENCODING = ENCODING_BITMAP
+DEFAULT_SINK = SINK_MEMORY
 
 logger = logging.getLogger(__name__)
 
-def worker_calculate_prime(worker, number_queue):
-    connection = worker.connect(config={
-        'sync_request_timeout': 60
-    })
-    result = connection.root.do_open(REDIS_CONNECT['host'], REDIS_CONNECT['port'], REDIS_CONNECT['db'])
-    # print(f'connected to {worker.node.name}')
-    while True:
-        try:
-            items = number_queue.get(False)
-            if items:
-                numbers = connection.root.calculate(REDIS_DATA_NAME, items[0], items[1])
-                if not numbers:
-                    logger.warn('cannot connect to redis db')
-        except queue.Empty:
-            break
-    connection.root.do_close()
-    connection.close()
-    # print(f'finished {worker.node.name}')
-
-def node_thread(node, is_restart, number_queue):
-    proc_list = []
-    worker = Worker(node, WORKER_PATH, WORKER_APP_NAME, WORKER_PORT )
-    connection = worker.startup(is_restart)
-    if not connection:
-        print(f'cannot connect to node {node.name}')
-        return
-    cpu_count = connection.root.get_cpu_count()
-    connection.close()
-    # print(f'start {worker.node.name} {cpu_count}')
-    for index in range(cpu_count * CPU_COUNT_FACTOR):
-        proc = Process(target=worker_calculate_prime, args=(worker, number_queue))
-        proc_list.append(proc)
-        proc.start()
-
-    for proc in proc_list:
-        proc.join()
-
-    # print(f'end node thread {node.name}')
-
-def is_proc_alive(proc_list):
-    for proc in proc_list:
-        if proc.is_alive():
-            return True
-    return False
+def parse_redis(text):
+    """
+    Return the redis connect settings from 'host[:port][/db]'.
+    """
+    text, _, db = text.partition('/')
+    host, _, port = text.partition(':')
+    return {
+        'host': host or REDIS_CONNECT['host'],
+        'port': int(port or REDIS_CONNECT['port']),
+        'db': int(db or REDIS_CONNECT['db']),
+    }
+
+def create_sink(args):
+    sink_name = SINK_COUNT if args.count_only else args.sink
+    if sink_name == SINK_COUNT:
+        return ResultSink(args.engine)
+    if sink_name == SINK_MEMORY:
+        return MemorySink(args.engine)
+    if sink_name == SINK_FILE:
+        return FileSink(args.engine, args.output)
+    return RedisSink(args.engine, parse_redis(args.redis), int(args.redis_batch_size), args.encoding)
+
+def reduce_block(journal, reduce, value, items, result):
+    new_value = reduce(value, items, result)
+    journal.record(items, new_value[0] - value[0])
+    return new_value
+
+def merge_stats(value, other):
+    return (value[0] + other[0], value[1] + other[1])
+
+def log_cache_stats(manager, worker_list):
+    for worker in worker_list:
+        with manager.borrow(worker) as connection:
+            hit_count, miss_count = connection.root.get_cache_stats()
+        logger.debug(f'{worker.node.name} base prime cache {hit_count} hits {miss_count} misses')
 
 def main():
     parser = argparse.ArgumentParser(description='Drip feeder for convex tokens')
 
     parser.add_argument('-b', '--block-count',
         default=DEFAULT_BLOCK_COUNT,
-        help=f'Number of numbers to send to each node. Default: {DEFAULT_BLOCK_COUNT}'
+        help=f'Number of numbers to send to each node to start with. Default: {DEFAULT_BLOCK_COUNT}'
+    )
+
+    parser.add_argument('-t', '--target-duration',
+        default=DEFAULT_TARGET_DURATION,
+        help=f'Seconds each block should take, 0 to keep the block count fixed. Default: {DEFAULT_TARGET_DURATION}'
+    )
+
+    parser.add_argument('-e', '--engine',
+        choices=[ENGINE_SIEVE, ENGINE_TRIAL],
+        default=DEFAULT_ENGINE,
+        help=f'Find the primes with a segmented sieve, or by trial division of each number. Default: {DEFAULT_ENGINE}'
+    )
+
+    parser.add_argument('--no-pipeline',
+        action='store_true',
+        help='Send each block in flight over a connection of its own, instead of pipelining blocks over one connection per node. Default: False'
     )
 
     parser.add_argument('-d', '--debug',
@@ -105,12 +137,11 @@ def main():
         help=f'Max number to calculate. Default: {DEFAULT_MAX_NUMBER}'
     )
 
-    if os.environ.get('CLUSTER_CONF', None):
-        CLUSTER_CONFIG_FILENAME = os.environ.get('CLUSTER_CONF')
+    cluster_config_filename = os.environ.get('CLUSTER_CONF', CLUSTER_CONFIG_FILENAME)
 
     parser.add_argument('--cluster',
-        default=CLUSTER_CONFIG_FILENAME,
-        help=f'Config cluster file. Default: {CLUSTER_CONFIG_FILENAME}'
+        default=cluster_config_filename,
+        help=f'Config cluster file. Default: {cluster_config_filename}'
     )
 
     parser.add_argument('--count',
@@ -123,19 +154,70 @@ def main():
         help=f'Node index to start with. Default: {DEFAULT_START_NODE}'
     )
 
+    parser.add_argument('--sink',
+        choices=SINK_NAMES,
+        default=DEFAULT_SINK,
+        help='Where to put the primes: a bitmap in memory sent back over the worker connections, '
+            'a memory mapped bitmap --output file, redis, or only count them. '
+            f'Default: {DEFAULT_SINK}'
+    )
+
+    parser.add_argument('-o', '--output',
+        default=DEFAULT_BITMAP_FILENAME,
+        help=f'Bitmap file for the file sink. Default: {DEFAULT_BITMAP_FILENAME}'
+    )
+
+    parser.add_argument('--redis',
+        default=DEFAULT_REDIS,
+        help=f'Redis server to write the primes to, as host[:port][/db]. Default: {DEFAULT_REDIS}'
+    )
+
+    parser.add_argument('--count-only',
+        action='store_true',
+        help='Only count the primes on each node, the same as --sink count. Default: False'
+    )
+
+    parser.add_argument('--encoding',
+        choices=[ENCODING_BITMAP, ENCODING_SET],
+        default=DEFAULT_ENCODING,
+        help=f'Write the primes to the redis sink as a bitmap of the odd numbers, or as a set of numbers. Default: {DEFAULT_ENCODING}'
+    )
+
+    parser.add_argument('--redis-batch-size',
+        default=DEFAULT_REDIS_BATCH_SIZE,
+        help=f'Most primes to write to redis in one command. Default: {DEFAULT_REDIS_BATCH_SIZE}'
+    )
+
+    parser.add_argument('--profile',
+        action='store_true',
+        help='calibrate the speed of each node again. Default: False'
+    )
+
     parser.add_argument('--restart',
         action='store_true',
         help='force restart of worker servers. Default: False'
     )
 
+    parser.add_argument('--journal',
+        default=DEFAULT_JOURNAL_FILENAME,
+        help=f'File to record the finished blocks in, so that the run can be resumed. Default: {DEFAULT_JOURNAL_FILENAME}'
+    )
+
+    parser.add_argument('--resume',
+        action='store_true',
+        help='Carry on the run recorded in the journal, and only send out the blocks it does not have. Default: False'
+    )
+
     args = parser.parse_args()
 
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
+    try:
+        sink = create_sink(args)
+    except ValueError as e:
+        print(e)
+        return
 
-
-    redis_db = redis.Redis(REDIS_CONNECT['host'], REDIS_CONNECT['port'], REDIS_CONNECT['db'])
-    redis_db.delete(REDIS_DATA_NAME)
     cluster = Cluster()
 
     logger.debug(f'loading cluster config file {args.cluster}')
@@ -146,57 +228,95 @@ def main():
     if args.restart:
         print('will restart workers')
 
-    number_queue = Queue()
-
-    proc_list = []
+    worker_list = []
     max_number = int(args.max)
     max_node_count = int(args.count)
     node_count = 0
     node_index = 1
-    current_number = 0
-    block_count = args.block_count
+    block_count = int(args.block_count)
+    target_duration = float(args.target_duration) or None
     start_time = time.time()
-    while current_number < max_number:
-        worker_block_count = min(max_number - current_number, block_count)
-        if worker_block_count > 0:
-            number_queue.put([current_number, current_number + worker_block_count])
-            current_number += worker_block_count 
-
-    max_queue_size = number_queue.qsize()
-    # print(f'Queue size {number_queue.qsize()}')
+
+    journal = Journal(args.journal)
+    # where the primes of the earlier run went, so that a resume cannot mix them with another output
+    is_redis = sink.name == SINK_REDIS
+    header = {
+        'app': 'prime',
+        'max': max_number,
+        'sink': sink.name,
+        'granularity': sink.granularity,
+        'output': os.path.abspath(args.output) if sink.name == SINK_FILE else None,
+        'redis': parse_redis(args.redis) if is_redis else None,
+        'encoding': args.encoding if is_redis else None,
+    }
+    try:
+        header, done_ranges, done_count = journal.open(header, args.resume)
+    except ValueError as e:
+        print(e)
+        return
+    done_size = done_ranges.size
+    if args.resume:
+        print(f'resuming {done_size} numbers from {args.journal}')
+
     for node in cluster.nodes:
         if node_index >= int(args.start):
-            proc = Process(target=node_thread, args=(node, args.restart, number_queue))
-            proc_list.append(proc)
-            proc.start()
+            worker_list.append(Worker(node, WORKER_PATH, WORKER_APP_NAME, WORKER_PORT))
             node_count += 1
             if node_count >= max_node_count and max_node_count > 0:
                 break
         node_index += 1
 
-    if len(proc_list) == 0:
+    progress = Progress(max_number, done_size)
+    manager = ConnectionManager(config={
+        'sync_request_timeout': 60
+    }, on_connect=sink.on_connect)
+    scheduler = Scheduler(
+        manager,
+        sink.call if args.no_pipeline else sink.call_async,
+        partial(reduce_block, journal, sink.reduce),
+        block_size=block_count,
+        target_duration=target_duration,
+        granularity=sink.granularity,
+        pipeline=not args.no_pipeline,
+        partial=lambda: (0, 0.0),
+        merge=merge_stats,
+        progress=progress
+    )
+    connection_list = startup_workers(worker_list, args.restart, config=manager.config)
+    for worker in scheduler.add_workers(worker_list, connection_list, args.profile):
+        print(f'cannot connect to node {worker.node.name}')
+
+    if len(scheduler.workers) == 0:
         print('Cannot connect to any workers')
         return
 
-    while is_proc_alive(proc_list):
-        percent_done = ((max_queue_size - number_queue.qsize()) / max_queue_size) * 100
-        print(f'\r{percent_done:0.1f}%', end='', flush=True)
+    sink.open(max_number, args.resume)
+    progress.start()
+    scheduler.start(GapCursor(0, max_number, done_ranges))
+    scheduler.join()
+    progress.close()
 
-    for proc in proc_list:
-       proc.join()
-
-    prime_numbers = {}
-    # result_len = redis_db.llen(REDIS_LIST_NAME)
-    # numbers = redis_db.lrange('prime', 0, result_len)
-    numbers = redis_db.smembers(REDIS_DATA_NAME)
-    for number in numbers:
-        prime_numbers[int(number)] = int(number)
+    if args.debug:
+        log_cache_stats(manager, scheduler.workers)
+    manager.close_all()
+    journal.close()
 
-    redis_db.delete(REDIS_DATA_NAME)
+    prime_count, write_time = scheduler.result()
+    found_count = sink.count(done_count + prime_count)
+    sink.close()
+    if done_size + scheduler.done_size != max_number:
+        print(f'\rOnly {done_size + scheduler.done_size} of {max_number} numbers were completed, run again with --resume to finish')
+        return 1
 
     done_time = time.time() - start_time
-    print(f'\rFound {len(prime_numbers.keys())} out of {max_number} prime numbers completed time {done_time:0.2f} seconds')
+    print(f'\rFound {found_count} out of {max_number} prime numbers completed time {done_time:0.2f} seconds')
+    print(f'{progress.summary()}')
+    if sink.name != SINK_COUNT:
+        block_count = max(1, scheduler.done_count)
+        print(f'{sink.name} write time {write_time:0.2f} seconds, {write_time / block_count * 1000:0.1f} ms per block over {block_count} blocks')
+    if sink.name == SINK_FILE:
+        print(f'primes bitmap written to {sink.filename}')
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""
+
+Result Sinks
+
+Where the prime calculator puts the primes that the workers find. Each sink
+chooses which worker method is called for a block, and folds the block
+results into the partial (prime_count, write_seconds) of each dispatch thread.
+
+The memory and file sinks keep the primes as a bitmap of the odd numbers,
+where bit k is the number 2k + 1, counted from the most significant bit of
+each byte. Byte n of the bitmap covers the numbers 16n to 16n + 15, so a file
+written by one run can be read back by another without a header.
+
+"""
+
+import logging
+import mmap
+import os
+import time
+
+from cluster.scheduler import async_method
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+SINK_COUNT = 'count'
+SINK_MEMORY = 'memory'
+SINK_FILE = 'file'
+SINK_REDIS = 'redis'
+SINK_NAMES = [SINK_MEMORY, SINK_FILE, SINK_REDIS, SINK_COUNT]
+
+# primes are written to redis as a set of numbers, or as a bitmap with a bit for each odd number
+ENCODING_SET = 'set'
+ENCODING_BITMAP = 'bitmap'
+# numbers covered by one byte of the bitmap, so blocks are sized in multiples of this
+BITMAP_BYTE_NUMBERS = 16
+
+DEFAULT_BITMAP_FILENAME = 'primes.bitmap'
+REDIS_DATA_NAME = 'prime'
+
+logger = logging.getLogger(__name__)
+
+
+def bitmap_size(max_number):
+    return -(-max_number // BITMAP_BYTE_NUMBERS)
+
+
+def bitmap_count(bitmap):
+    """
+    Return the number of bits set in the bitmap.
+    """
+    return bin(int.from_bytes(bitmap, 'big')).count('1')
+
+
+class ResultSink:
+    """
+    Counts the primes of each block on the workers, and keeps nothing else.
+    """
+
+    name = SINK_COUNT
+    granularity = 1
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def open(self, max_number, is_resume=False):
+        """
+        Get ready for the primes up to `max_number`. If `is_resume` is True, keep the primes of the earlier run.
+        """
+        pass
+
+    def on_connect(self, connection):
+        pass
+
+    def call(self, connection, items):
+        return connection.root.count(items[0], items[1], self._engine)
+
+    def call_async(self, connection, items):
+        return async_method(connection, 'count')(items[0], items[1], self._engine)
+
+    def reduce(self, value, items, result):
+        return (value[0] + result, value[1])
+
+    def count(self, prime_count):
+        """
+        Return the number of primes found, from the sum of the block counts.
+        """
+        return prime_count
+
+    def close(self):
+        pass
+
+
+class MemorySink(ResultSink):
+    """
+    Streams the bitmap of each block back over the rpyc connection, into one bitmap held by the controller,
+    and counts the primes from the bits of each block.
+    """
+
+    name = SINK_MEMORY
+    granularity = BITMAP_BYTE_NUMBERS
+
+    def __init__(self, engine):
+        super().__init__(engine)
+        self._bitmap = None
+
+    def open(self, max_number, is_resume=False):
+        if is_resume:
+            logger.warning('the memory bitmap only has the primes found by this run')
+        self._bitmap = bytearray(bitmap_size(max_number))
+
+    def call(self, connection, items):
+        return connection.root.calculate_bitmap(items[0], items[1], self._engine)
+
+    def call_async(self, connection, items):
+        return async_method(connection, 'calculate_bitmap')(items[0], items[1], self._engine)
+
+    def reduce(self, value, items, result):
+        bitmap = result
+        start_time = time.perf_counter()
+        # the blocks do not overlap, so each thread writes to its own part of the bitmap
+        offset = items[0] // BITMAP_BYTE_NUMBERS
+        self._bitmap[offset:offset + len(bitmap)] = bitmap
+        # the bitmap only has the odd numbers, so add on 2
+        prime_count = bitmap_count(bitmap) + (1 if items[0] <= 2 < items[1] else 0)
+        return (value[0] + prime_count, value[1] + time.perf_counter() - start_time)
+
+    @property
+    def bitmap(self):
+        return self._bitmap
+
+
+class FileSink(MemorySink):
+    """
+    Writes the bitmap of each block into a memory mapped file, which is kept after the run.
+    """
+
+    name = SINK_FILE
+
+    def __init__(self, engine, filename=DEFAULT_BITMAP_FILENAME):
+        super().__init__(engine)
+        self._filename = filename
+        self._fp = None
+
+    def open(self, max_number, is_resume=False):
+        size = bitmap_size(max_number)
+        is_keep = is_resume and os.path.exists(self._filename)
+        self._fp = open(self._filename, 'r+b' if is_keep else 'w+b')
+        self._fp.truncate(size)
+        self._bitmap = mmap.mmap(self._fp.fileno(), size) if size else bytearray()
+
+    def close(self):
+        if isinstance(self._bitmap, mmap.mmap):
+            self._bitmap.flush()
+            self._bitmap.close()
+        self._bitmap = None
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+
+    @property
+    def filename(self):
+        return self._filename
+
+
+class RedisSink(ResultSink):
+    """
+    Has each worker write its primes straight to redis, as a set or a bitmap, and counts them there at the end.
+    """
+
+    name = SINK_REDIS
+
+    def __init__(self, engine, redis_connect, batch_size, encoding=ENCODING_BITMAP):
+        super().__init__(engine)
+        if redis is None:
+            raise ValueError('the redis sink needs the redis package')
+        self._redis_connect = redis_connect
+        self._batch_size = batch_size
+        self._encoding = encoding
+        self._max_number = 0
+        self._redis = None
+        self.granularity = BITMAP_BYTE_NUMBERS if encoding == ENCODING_BITMAP else 1
+
+    def open(self, max_number, is_resume=False):
+        self._max_number = max_number
+        self._redis = redis.Redis(self._redis_connect['host'], self._redis_connect['port'], self._redis_connect['db'])
+        if not is_resume:
+            # start from an empty key, the primes from earlier runs would be counted again
+            self._redis.delete(REDIS_DATA_NAME)
+
+    def on_connect(self, connection):
+        redis_connect = self._redis_connect
+        if not connection.root.do_open(redis_connect['host'], redis_connect['port'], redis_connect['db'], self._batch_size):
+            logger.warning('cannot connect to redis db')
+
+    def call(self, connection, items):
+        return connection.root.calculate(REDIS_DATA_NAME, items[0], items[1], self._engine, self._encoding)
+
+    def call_async(self, connection, items):
+        return async_method(connection, 'calculate')(REDIS_DATA_NAME, items[0], items[1], self._engine, self._encoding)
+
+    def reduce(self, value, items, result):
+        if result is None:
+            # fail the block, so that it is sent out again on a new connection, which opens redis again
+            raise ConnectionError('the worker cannot connect to the redis db')
+        return (value[0] + result[0], value[1] + result[1])
+
+    def count(self, prime_count):
+        if self._encoding == ENCODING_BITMAP:
+            # the bitmap only has the odd numbers, so add on 2
+            return self._redis.bitcount(REDIS_DATA_NAME) + (1 if self._max_number > 2 else 0)
+        return self._redis.scard(REDIS_DATA_NAME)
+
+    def close(self):
+        self._redis = None
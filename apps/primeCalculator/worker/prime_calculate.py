@@ -1,17 +1,294 @@
 #!/usr/bin/env  python3
 
+import argparse
 import cpuinfo
+import itertools
 import math
-import redis
+import os
 import rpyc
+import sys
+import time
 
+from array import array
+from multiprocessing import Pool
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+WORKER_READY_TOKEN = 'worker ready'
 PRIME_CALC_PORT = 18882
 
+# smallest range worth sending to another process
+MIN_SPLIT_SIZE = 1000
+# number of odd numbers sieved at a time, one byte each, so that the segment stays in the cpu cache
+SEGMENT_SIZE = 0x8000
+
+ENGINE_SIEVE = 'sieve'
+ENGINE_TRIAL = 'trial'
+
+# most primes to send to redis in one sadd command
+DEFAULT_REDIS_BATCH_SIZE = 10000
+
+# primes are written to redis as a set of numbers, or as a bitmap with a bit for each odd number
+ENCODING_SET = 'set'
+ENCODING_BITMAP = 'bitmap'
+# numbers covered by one byte of the bitmap, blocks must start on a multiple of this
+BITMAP_BYTE_NUMBERS = 16
+# turns a flag byte of 0 or 1 for each odd number into the text of a binary number
+FLAG_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+
+# base primes found before the process pool is forked, enough for numbers up to 2^32
+BASE_PRIME_START_LIMIT = 0x10000
+# largest base prime to keep, about 16 MB of primes, so for numbers up to about 2^52
+BASE_PRIME_MAX_LIMIT = 0x4000000
+
+# process pool with one process per core, started before the server
+process_pool = None
+
+# base prime cache hits of all of the processes, kept by the server process
+cache_stats = {
+    'hit_count': 0,
+    'miss_count': 0,
+}
+
+
+def split_range(from_number, to_number, count, align=1):
+    step = max(MIN_SPLIT_SIZE, -(-(to_number - from_number) // count))
+    # round up, so that each part starts on a multiple of `align` if `from_number` does
+    step = -(-step // align) * align
+    return [(start, min(start + step, to_number)) for start in range(from_number, to_number, step)]
+
+
+def calculate_prime(from_number, to_number, engine=ENGINE_SIEVE):
+    if engine == ENGINE_SIEVE:
+        return sieve_prime(from_number, to_number)
+    if engine != ENGINE_TRIAL:
+        raise ValueError(f'unknown engine {engine}')
+    result = []
+    for number in range(from_number, to_number):
+        if is_prime(number):
+            result.append(number)
+    return result
+
+
+def count_prime(from_number, to_number, engine=ENGINE_SIEVE):
+    if engine == ENGINE_SIEVE:
+        return sieve_count(from_number, to_number)
+    return len(calculate_prime(from_number, to_number, engine))
+
+
+def calculate_prime_items(items):
+    hit_count = base_prime_cache.hit_count
+    prime_numbers = calculate_prime(*items)
+    return prime_numbers, base_prime_cache.hit_count - hit_count
+
+
+def bitmap_prime_items(items):
+    hit_count = base_prime_cache.hit_count
+    bitmap = calculate_bitmap(*items)
+    return bitmap, base_prime_cache.hit_count - hit_count
+
+
+def count_prime_items(items):
+    hit_count = base_prime_cache.hit_count
+    prime_count = count_prime(*items)
+    return prime_count, base_prime_cache.hit_count - hit_count
+
+
+def integer_sqrt(number):
+    root = int(math.sqrt(number))
+    while root * root > number:
+        root -= 1
+    while (root + 1) * (root + 1) <= number:
+        root += 1
+    return root
+
+
+class BasePrimeCache:
+    """
+    Odd primes up to a limit in a compact array, extended as larger blocks need more of them.
+    Each process has a cache of its own, so nothing is locked.
+    """
+
+    def __init__(self, max_limit=BASE_PRIME_MAX_LIMIT):
+        self._max_limit = max_limit
+        self._limit = 2
+        self._primes = array('I')
+        self._hit_count = 0
+        self._miss_count = 0
+
+    def primes(self, limit):
+        """
+        Return the odd primes up to at least `limit`, the list may go on past it.
+        """
+        if limit <= self._limit:
+            self._hit_count += 1
+            return self._primes
+        self._miss_count += 1
+        if limit > self._max_limit:
+            return base_primes(limit)
+        # at least double the limit, so that a node working up through the numbers extends it only a few times
+        new_limit = min(max(limit, self._limit * 2), self._max_limit)
+        if self._limit * self._limit >= new_limit:
+            self._primes.extend(sieve_prime(self._limit + 1, new_limit + 1, self._primes))
+        else:
+            self._primes = array('I', base_primes(new_limit))
+        self._limit = new_limit
+        return self._primes
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def hit_count(self):
+        return self._hit_count
+
+    @property
+    def miss_count(self):
+        return self._miss_count
+
+
+base_prime_cache = BasePrimeCache()
+
+
+def calculate_bitmap(from_number, to_number, engine=ENGINE_SIEVE):
+    """
+    Return the odd primes from `from_number` up to `to_number` as a bitmap, see `encode_bitmap`.
+    The sieve engine builds it straight from the sieve segments, without a list of the primes.
+    """
+    if engine != ENGINE_SIEVE:
+        return encode_bitmap(from_number, to_number, calculate_prime(from_number, to_number, engine))
+    if from_number % BITMAP_BYTE_NUMBERS:
+        raise ValueError(f'range start {from_number} is not a multiple of {BITMAP_BYTE_NUMBERS}')
+    byte_count = -(-(to_number - from_number) // BITMAP_BYTE_NUMBERS)
+    if not byte_count:
+        return b''
+    # a flag byte for each bit of the bitmap, packed into bits at the end
+    flags = bytearray(byte_count * 8)
+    start = from_number // 2
+    for segment_start, segment_end, segment in sieve_segments(from_number, to_number):
+        index = (segment_start >> 1) - start
+        flags[index:index + len(segment)] = segment
+    return int(flags.translate(FLAG_DIGITS), 2).to_bytes(byte_count, 'big')
+
+
+def bitmap_count(bitmap):
+    """
+    Return the number of bits set in the bitmap.
+    """
+    return bin(int.from_bytes(bitmap, 'big')).count('1')
+
+
+def encode_bitmap(from_number, to_number, prime_numbers):
+    """
+    Return the odd primes from `from_number` up to `to_number` as a bitmap, where bit k is the odd
+    number 2k + 1, counted from the most significant bit of the first byte as redis does. The bitmap
+    for the block starts at byte from_number / 16 of the bitmap of all numbers.
+    """
+    if from_number % BITMAP_BYTE_NUMBERS:
+        raise ValueError(f'range start {from_number} is not a multiple of {BITMAP_BYTE_NUMBERS}')
+    bitmap = bytearray(-(-(to_number - from_number) // BITMAP_BYTE_NUMBERS))
+    start = from_number // 2
+    for prime_number in prime_numbers:
+        if prime_number & 1:
+            index = (prime_number >> 1) - start
+            bitmap[index >> 3] |= 0x80 >> (index & 7)
+    return bytes(bitmap)
+
+
+def base_primes(limit):
+    """
+    Return the odd primes up to and including `limit`.
+    """
+    if limit < 3:
+        return []
+    # index i is the odd number 2i + 1
+    flags = bytearray([1]) * (limit // 2 + 1)
+    flags[0] = 0
+    for index in range(1, integer_sqrt(limit) // 2 + 1):
+        if flags[index]:
+            number = index * 2 + 1
+            start = number * number // 2
+            flags[start::number] = bytes(len(range(start, len(flags), number)))
+    return list(itertools.compress(range(1, limit + 1, 2), flags))
+
+
+def sieve_segments(from_number, to_number, prime_list=None):
+    """
+    Sieve the odd numbers from `from_number` up to `to_number` a segment at a time, and yield
+    (segment_start, segment_end, segment) for each one, where segment[i] is 1 if segment_start + 2i is prime.
+    `prime_list` is the odd primes up to at least the square root of `to_number`, by default from the cache.
+    """
+    low = max(from_number, 3) | 1
+    if low >= to_number:
+        return
+    if prime_list is None:
+        prime_list = base_prime_cache.primes(integer_sqrt(to_number - 1))
+    zeros = memoryview(bytes(SEGMENT_SIZE))
+    for segment_start in range(low, to_number, SEGMENT_SIZE * 2):
+        segment_end = min(segment_start + SEGMENT_SIZE * 2, to_number)
+        count = (segment_end - segment_start + 1) // 2
+        segment = bytearray([1]) * count
+        for prime in prime_list:
+            square = prime * prime
+            if square >= segment_end:
+                break
+            # the first odd multiple of the prime in the segment, and not below its square
+            start = max(square, -(-segment_start // prime) * prime)
+            if start % 2 == 0:
+                start += prime
+            index = (start - segment_start) // 2
+            if index < count:
+                segment[index::prime] = zeros[:(count - 1 - index) // prime + 1]
+        yield segment_start, segment_end, segment
+
+
+def sieve_prime(from_number, to_number, prime_list=None):
+    """
+    Return the primes from `from_number` up to `to_number` with a segmented sieve of the odd numbers.
+    """
+    result = []
+    if from_number <= 2 < to_number:
+        result.append(2)
+    for segment_start, segment_end, segment in sieve_segments(from_number, to_number, prime_list):
+        result.extend(itertools.compress(range(segment_start, segment_end, 2), segment))
+    return result
+
+
+def sieve_count(from_number, to_number):
+    """
+    Return the number of primes from `from_number` up to `to_number`, without making a list of them.
+    """
+    result = 1 if from_number <= 2 < to_number else 0
+    for segment_start, segment_end, segment in sieve_segments(from_number, to_number):
+        result += segment.count(1)
+    return result
+
+
+def is_prime(number):
+    if number < 2:
+        return False
+
+    index = 2
+    limit = int(math.sqrt(number)) + 1
+    while index < limit:
+        if number % index == 0:
+            return False
+        index += 1
+
+    return True
+
 
 class PrimeCalculatorWorker(rpyc.Service):
+    ALIASES = ['prime_calculate']
+
     def __init__(self):
         rpyc.Service.__init__(self)
         self._redis = None
+        self._batch_size = DEFAULT_REDIS_BATCH_SIZE
 
     def on_connect(self, connection):
         print('connect')
@@ -19,50 +296,136 @@ class PrimeCalculatorWorker(rpyc.Service):
     def on_disconnect(self, connection):
         print('disconnect')
 
-    def exposed_do_open(self, host, port, db):
+    def exposed_do_open(self, host, port, db, batch_size=DEFAULT_REDIS_BATCH_SIZE):
+        if redis is None:
+            return False
         self._redis = redis.Redis(host=host, port=port, db=db)
+        self._batch_size = max(1, batch_size)
         return self._redis.ping()
 
     def exposed_do_close(self):
         if self._redis:
             self._redis = None
 
-    def exposed_calculate(self, data_name, from_number, to_number):
-        prime_numbers = self.calculate_prime(from_number, to_number)
-        if self._redis:
-            for prime_number in prime_numbers:
-                self._redis.sadd(data_name, prime_number)
-            # self._redis.rpush(list_name, *prime_numbers)
-            return prime_numbers
-        return None
+    def exposed_calculate(self, data_name, from_number, to_number, engine=ENGINE_SIEVE, encoding=ENCODING_SET):
+        """
+        Add the primes in the range to the redis set or bitmap, and return the number of primes
+        and the seconds spent writing them, or None if redis is not open.
+        """
+        if not self._redis:
+            return None
+        if encoding == ENCODING_BITMAP:
+            bitmap = self.calculate_bitmap(from_number, to_number, engine)
+            # the bitmap only has the odd numbers, so add on 2
+            prime_count = bitmap_count(bitmap) + (1 if from_number <= 2 < to_number else 0)
+            return (prime_count, self.write_bitmap(data_name, from_number, bitmap))
+        prime_numbers = self.calculate_prime(from_number, to_number, engine)
+        return (len(prime_numbers), self.write_primes(data_name, prime_numbers))
+
+    def exposed_calculate_bitmap(self, from_number, to_number, engine=ENGINE_SIEVE):
+        """
+        Return the odd primes in the range as a bitmap.
+        """
+        return self.calculate_bitmap(from_number, to_number, engine)
+
+    def exposed_count(self, from_number, to_number, engine=ENGINE_SIEVE):
+        """
+        Return the number of primes in the range, without writing them anywhere.
+        """
+        return sum(self.run_parts(count_prime_items, from_number, to_number, engine))
+
+    def write_bitmap(self, data_name, from_number, bitmap):
+        start_time = time.perf_counter()
+        self._redis.setrange(data_name, from_number // BITMAP_BYTE_NUMBERS, bitmap)
+        return time.perf_counter() - start_time
+
+    def write_primes(self, data_name, prime_numbers):
+        start_time = time.perf_counter()
+        # one round trip for the block, with up to the batch size of primes in each sadd
+        pipeline = self._redis.pipeline(transaction=False)
+        for index in range(0, len(prime_numbers), self._batch_size):
+            pipeline.sadd(data_name, *prime_numbers[index:index + self._batch_size])
+        pipeline.execute()
+        return time.perf_counter() - start_time
+
+    def exposed_get_cache_stats(self):
+        """
+        Return the number of sieved parts that found their base primes in the cache, and the number that did not.
+        """
+        return (cache_stats['hit_count'], cache_stats['miss_count'])
 
     def exposed_get_cpu_count(self):
         info = cpuinfo.get_cpu_info()
         return info['count']        
 
-    def calculate_prime(self, from_number, to_number):
+    def exposed_get_cpu_info(self):
+        info = cpuinfo.get_cpu_info()
+        hz_actual = info.get('hz_actual', [0, 0])[0]
+        return (info.get('arch'), info.get('count'), hz_actual)
+
+    def exposed_calibrate(self, loop_count):
+        start_time = time.perf_counter()
+        value = 0
+        for index in range(loop_count):
+            value = (value * 31 + index) % 1000003
+        return time.perf_counter() - start_time
+
+    def calculate_prime(self, from_number, to_number, engine=ENGINE_SIEVE):
         result = []
-        for number in range(from_number, to_number):
-            if self.is_prime(number):
-                result.append(number)
+        for prime_numbers in self.run_parts(calculate_prime_items, from_number, to_number, engine):
+            result.extend(prime_numbers)
         return result
 
-    def is_prime(self, number):
-        if number < 2:
-            return False
-
-        index = 2
-        limit = int(math.sqrt(number)) + 1
-        while index < limit:
-            if number % index == 0:
-                return False
-            index += 1
+    def calculate_bitmap(self, from_number, to_number, engine=ENGINE_SIEVE):
+        # each part starts on a byte of the bitmap, so the bitmaps of the parts join up
+        bitmap_list = self.run_parts(bitmap_prime_items, from_number, to_number, engine, BITMAP_BYTE_NUMBERS)
+        return b''.join(bitmap_list)
 
-        return True
+    def run_parts(self, function, from_number, to_number, engine, align=1):
+        """
+        Split the range over the process pool, one part for each core, and return the result of each part in order.
+        Each part starts on a multiple of `align` if `from_number` does.
+        """
+        item_list = [(start, stop, engine) for start, stop in split_range(from_number, to_number, os.cpu_count(), align)]
+        if process_pool is None or len(item_list) < 2:
+            item_list = [(from_number, to_number, engine)]
+            result_list = [function(item_list[0])]
+        else:
+            result_list = process_pool.imap(function, item_list)
+        value_list = []
+        for (value, hit_count), item in zip(result_list, item_list):
+            value_list.append(value)
+            if item[2] == ENGINE_SIEVE:
+                cache_stats['hit_count'] += hit_count
+                cache_stats['miss_count'] += 1 - hit_count
+        return value_list
 
 def main():
-    from rpyc.utils.server import ForkingServer
-    server = ForkingServer(PrimeCalculatorWorker, port=PRIME_CALC_PORT)
+    from rpyc.utils.server import ThreadedServer
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port',
+        type=int,
+        default=PRIME_CALC_PORT,
+        help=f'Port to listen on. Default: {PRIME_CALC_PORT}'
+    )
+    args = parser.parse_args()
+
+    global process_pool
+    # fill the cache first, so that each forked process starts with a copy of it
+    base_prime_cache.primes(BASE_PRIME_START_LIMIT)
+    process_pool = Pool(os.cpu_count())
+
+    server = ThreadedServer(PrimeCalculatorWorker, port=args.port)
+    # listen before telling the controller that the server is ready
+    server._listen()
+    try:
+        print(WORKER_READY_TOKEN, flush=True)
+    except BrokenPipeError:
+        # the controller connected before it read the token, and has closed the pipe
+        pass
+    # nothing reads the output after this, so do not write to a closed pipe
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
     server.start()
 
 
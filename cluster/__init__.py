@@ -7,4 +7,11 @@
 
 
 from cluster.cluster import Cluster
-from cluster.worker import Worker
+from cluster.connection_manager import ConnectionManager
+from cluster.journal import Journal
+from cluster.progress import Progress
+from cluster.scheduler import Scheduler
+from cluster.worker import (
+    Worker,
+    startup_workers
+)
@@ -9,10 +9,21 @@ import re
 import os
 import yaml
 
+from cluster.local_node import (
+    LOCAL_PORT_STRIDE,
+    LocalNode
+)
 from cluster.node import Node
 from cluster.controller import Controller
+from cluster.session import (
+    DEFAULT_IDLE_TIMEOUT,
+    SessionPool
+)
 
 
+NODE_TYPE_SSH = 'ssh'
+NODE_TYPE_LOCAL = 'local'
+
 logger = logging.getLogger(__name__)
 
 class Cluster:
@@ -22,6 +33,7 @@ class Cluster:
         self._nodes = []
         self._worker_path = None
         self._controller = None
+        self._session_pool = None
 
     def load_config(self, config_filename):
         self._config = None
@@ -30,6 +42,7 @@ class Cluster:
                 self._config = yaml.safe_load(fp)
                 #self._worker_path = os.path.expandvars(self._config['worker_path'])
                 self._worker_path = self._config['worker_path']
+                self._session_pool = SessionPool(idle_timeout=self._config.get('ssh_idle_timeout', DEFAULT_IDLE_TIMEOUT))
                 self.load_nodes()
                 data = self._config.get('controller', None)
                 if data:
@@ -40,15 +53,26 @@ class Cluster:
     def load_nodes(self):
         self._nodes = []
         index = 1
+        local_count = 0
         for item in self.config['nodes']:
-            node = Node(
-                index, 
-                item['name'], 
-                item['hostname'], 
-                item['username'], 
-                self.config['key_file'], 
-                self._worker_path
-            ) 
+            if item.get('type', NODE_TYPE_SSH) == NODE_TYPE_LOCAL:
+                node = LocalNode(
+                    index,
+                    item['name'],
+                    self._worker_path,
+                    item.get('port_offset', local_count * LOCAL_PORT_STRIDE)
+                )
+                local_count += 1
+            else:
+                node = Node(
+                    index, 
+                    item['name'], 
+                    item['hostname'], 
+                    item['username'], 
+                    self.config['key_file'], 
+                    self._worker_path,
+                    self._session_pool
+                ) 
             self.nodes.append(node)
             index += 1
 
@@ -0,0 +1,173 @@
+"""
+
+Connection Manager
+
+Keeps warm rpyc connections to the workers keyed by (hostname, port), checks
+idle connections with a periodic ping, and lends them out to callers.
+
+"""
+
+import logging
+import threading
+
+from contextlib import contextmanager
+
+DEFAULT_PING_INTERVAL = 10
+DEFAULT_PING_TIMEOUT = 3
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionManager:
+
+    def __init__(self, config=None, ping_interval=DEFAULT_PING_INTERVAL, ping_timeout=DEFAULT_PING_TIMEOUT, on_connect=None):
+        """
+        :param on_connect: optional function(connection) called once for each new connection.
+        """
+        self._config = config or {}
+        self._on_connect = on_connect
+        self._ping_interval = ping_interval
+        self._ping_timeout = ping_timeout
+        self._idle = {}
+        self._workers = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._ping_thread = None
+
+    @staticmethod
+    def key(worker):
+        return (worker.node.hostname, worker.port)
+
+    def add(self, worker, connection):
+        """
+        Add an already open connection, such as the one returned by `Worker.startup`.
+        """
+        if self._on_connect:
+            self._on_connect(connection)
+        key = self.key(worker)
+        with self._lock:
+            self._workers[key] = worker
+            self._idle.setdefault(key, []).append(connection)
+        self._start_ping()
+
+    @contextmanager
+    def borrow(self, worker):
+        """
+        Lend a connection to the worker for the time of the `with` block.
+        A new connection is made if there are no idle connections, or if the idle ones have gone,
+        such as after the worker has been restarted. If the block raises an error, the connection
+        is closed and the error is raised, so that the caller can try again on a new connection.
+        """
+        connection = self.acquire(worker)
+        try:
+            yield connection
+        except Exception:
+            # the connection may have gone, or have a reply still to come, so do not put it back
+            self.close(connection)
+            raise
+        else:
+            self.release(worker, connection)
+
+    def acquire(self, worker):
+        key = self.key(worker)
+        while True:
+            with self._lock:
+                self._workers[key] = worker
+                idle_list = self._idle.setdefault(key, [])
+                connection = idle_list.pop() if idle_list else None
+            if connection is None:
+                break
+            if self.is_alive(connection):
+                return connection
+            logger.debug(f'idle connection gone {key}')
+            self.close(connection)
+        logger.debug(f'new connection {key}')
+        connection = worker.connect(config=self._config)
+        if not connection:
+            raise ConnectionError(f'cannot connect to {worker.node.hostname}:{worker.port}')
+        if self._on_connect:
+            self._on_connect(connection)
+        self._start_ping()
+        return connection
+
+    @staticmethod
+    def is_alive(connection):
+        """
+        Return False if the connection is closed, or the worker has closed its end. This does not
+        wait for a reply, it only reads anything that has already come in on the connection.
+        """
+        if connection.closed:
+            return False
+        try:
+            # serve what has come in, such as the close request sent by a worker as it exits,
+            # until the connection is empty or reading it finds that it has gone
+            while connection.poll(0):
+                pass
+        except Exception:
+            return False
+        return not connection.closed
+
+    def release(self, worker, connection):
+        if connection.closed:
+            return
+        with self._lock:
+            if not self._stop_event.is_set():
+                self._idle.setdefault(self.key(worker), []).append(connection)
+                return
+        self.close(connection)
+
+    def ping_all(self):
+        """
+        Ping all of the idle connections, and drop the ones that do not answer.
+        """
+        with self._lock:
+            item_list = [(key, connection) for key, idle_list in self._idle.items() for connection in idle_list]
+            for key, idle_list in self._idle.items():
+                idle_list.clear()
+
+        for key, connection in item_list:
+            try:
+                connection.ping(timeout=self._ping_timeout)
+            except Exception as e:
+                logger.debug(f'ping failed {key}: {e}')
+                self.close(connection)
+                continue
+            with self._lock:
+                # close_all may have been called during the ping, so the connection is not kept
+                if not self._stop_event.is_set():
+                    self._idle.setdefault(key, []).append(connection)
+                    continue
+            self.close(connection)
+
+    def close_all(self):
+        self._stop_event.set()
+        with self._lock:
+            item_list = [connection for idle_list in self._idle.values() for connection in idle_list]
+            self._idle = {}
+        for connection in item_list:
+            self.close(connection)
+
+    def _start_ping(self):
+        with self._lock:
+            if self._ping_thread or not self._ping_interval:
+                return
+            self._ping_thread = threading.Thread(target=self._ping_loop, daemon=True)
+            self._ping_thread.start()
+
+    def _ping_loop(self):
+        while not self._stop_event.wait(self._ping_interval):
+            self.ping_all()
+
+    def close(self, connection):
+        try:
+            connection.close()
+        except Exception as e:
+            logger.debug(f'close connection error: {e}')
+
+    def idle_count(self, worker):
+        with self._lock:
+            return len(self._idle.get(self.key(worker), []))
+
+    @property
+    def config(self):
+        return self._config
@@ -0,0 +1,120 @@
+"""
+
+Node Command Executor
+
+Runs a command line for many nodes from a single process using asyncio,
+with a limit on the number of commands running at the same time.
+
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import time
+
+DEFAULT_CONCURRENCY = 32
+DEFAULT_TIMEOUT = 60
+
+logger = logging.getLogger(__name__)
+
+
+class NodeResult:
+
+    def __init__(self, node, return_code, latency, is_timeout=False):
+        self._node = node
+        self._return_code = return_code
+        self._latency = latency
+        self._is_timeout = is_timeout
+
+    @property
+    def node(self):
+        return self._node
+
+    @property
+    def return_code(self):
+        return self._return_code
+
+    @property
+    def latency(self):
+        return self._latency
+
+    @property
+    def is_timeout(self):
+        return self._is_timeout
+
+    @property
+    def is_success(self):
+        return self._return_code == 0 and not self._is_timeout
+
+    @property
+    def status(self):
+        return 'timeout' if self._is_timeout else f'exit {self._return_code}'
+
+    def __str__(self):
+        return f'{self._node.name} {self._latency:0.2f}s {self.status}'
+
+
+class Executor:
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT, output=print):
+        self._concurrency = concurrency
+        self._timeout = timeout
+        self._output = output
+
+    def run(self, job_list):
+        """
+        Run each (node, line) job and return a list of `NodeResult` in the same order.
+        Output from each command is passed to `output` line by line, prefixed with the node name.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run_async(job_list))
+        finally:
+            loop.close()
+
+    async def run_async(self, job_list):
+        semaphore = asyncio.Semaphore(self._concurrency)
+        task_list = [self._run_job(semaphore, node, line) for node, line in job_list]
+        return await asyncio.gather(*task_list)
+
+    async def _run_job(self, semaphore, node, line):
+        async with semaphore:
+            logger.debug(f'{node.name}: {" ".join(line)}')
+            start_time = time.time()
+            proc = await asyncio.create_subprocess_exec(
+                *line,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                start_new_session=True
+            )
+            is_timeout = False
+            try:
+                await asyncio.wait_for(self._read_output(node, proc), self._timeout)
+            except asyncio.TimeoutError:
+                is_timeout = True
+                # kill the whole group, so that no child process keeps the output pipe open
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    # the group has already exited
+                    pass
+                await proc.wait()
+            return NodeResult(node, proc.returncode, time.time() - start_time, is_timeout)
+
+    async def _read_output(self, node, proc):
+        while True:
+            data = await proc.stdout.readline()
+            if not data:
+                break
+            self._output(f'{node.name}: {data.decode(errors="replace").rstrip()}')
+        await proc.wait()
+
+    @property
+    def concurrency(self):
+        return self._concurrency
+
+    @property
+    def timeout(self):
+        return self._timeout
@@ -0,0 +1,192 @@
+"""
+
+Journal
+
+Append only record of the finished ranges of a job and the partial result of
+each one, so that a job can be resumed after the controller or a node dies.
+The first line is a header that describes the job, and each line after it is
+one finished task as the json list [from, to, value].
+
+Records are kept in memory and written out in batches by a flush thread, so
+that a dispatch thread only takes a lock to append to a list. If the
+controller dies, at most the last flush interval of tasks are lost, and those
+ranges are sent out again on resume.
+
+"""
+
+import json
+import logging
+import os
+import threading
+
+from cluster.scheduler import RangeSet
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+# bytes read at a time from the end of the journal, when looking for the end of the last whole line
+TAIL_READ_SIZE = 0x1000
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+
+    def __init__(self, filename, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self._filename = filename
+        self._flush_interval = flush_interval
+        self._fp = None
+        self._pending = []
+        self._record_count = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._flush_thread = None
+
+    def load_header(self):
+        """
+        Return the header of the journal, or None if there is no journal.
+        """
+        if not os.path.exists(self._filename):
+            return None
+        with open(self._filename, 'r') as fp:
+            try:
+                return json.loads(fp.readline())
+            except ValueError:
+                return None
+
+    def records(self):
+        """
+        Yield the (from, to, value) records in the journal one at a time, so that a long journal
+        does not need to be read into memory. A last line cut short by a crash is left out.
+        """
+        if not os.path.exists(self._filename):
+            return
+        with open(self._filename, 'r') as fp:
+            fp.readline()
+            for line in fp:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    logger.debug(f'journal {self._filename} skipping line {line!r}')
+                    continue
+                if isinstance(item, list) and len(item) == 3:
+                    yield (item[0], item[1], item[2])
+
+    def create(self, header):
+        """
+        Start a new journal for the job described by the `header` dict.
+        """
+        self._fp = open(self._filename, 'w')
+        self._fp.write(json.dumps(header) + '\n')
+        self._fp.flush()
+        self._record_count = 0
+        self._start_flush()
+
+    def append(self):
+        """
+        Carry on writing to the journal of an earlier run. A last line cut short by a crash is
+        removed first, so that the next record does not end up on the same line.
+        """
+        self._truncate_line()
+        self._fp = open(self._filename, 'a')
+        self._start_flush()
+
+    def resume(self, header):
+        """
+        Return the header of the earlier run of the job described by `header`, and carry on writing
+        to its journal, the finished tasks can then be read with `records`. A key in `header` with a
+        value of None matches anything, and is filled in from the journal.
+        Raises ValueError if there is no journal, or it is for a different job.
+        """
+        last_header = self.load_header()
+        if last_header is None:
+            raise ValueError(f'no journal {self._filename} to resume from')
+        header = {key: last_header.get(key) if value is None else value for key, value in header.items()}
+        if header != last_header:
+            raise ValueError(f'journal {self._filename} is for a different job {last_header}')
+        self.append()
+        return header
+
+    def open(self, header, is_resume=False):
+        """
+        Start a new journal for the job described by `header`, or if `is_resume` is True carry on
+        the journal of an earlier run of it, see `resume`. Returns (header, done_ranges, done_value),
+        where done_ranges is a `RangeSet` of the ranges already finished, and done_value is the sum of
+        their values, both empty for a new journal.
+        Raises ValueError if there is no journal to resume, or it is for a different job.
+        """
+        done_ranges = RangeSet()
+        done_value = 0
+        if not is_resume:
+            self.create(header)
+            return header, done_ranges, done_value
+        header = self.resume(header)
+        for from_number, to_number, value in self.records():
+            done_ranges.add(from_number, to_number)
+            done_value += value
+        return header, done_ranges, done_value
+
+    def record(self, task, value):
+        with self._lock:
+            self._pending.append((task[0], task[1], value))
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                item_list = self._pending
+                self._pending = []
+            if not item_list or not self._fp:
+                return
+            self._fp.write(''.join(json.dumps(item) + '\n' for item in item_list))
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            self._record_count += len(item_list)
+
+    def close(self):
+        self._stop_event.set()
+        if self._flush_thread:
+            self._flush_thread.join()
+            self._flush_thread = None
+        self.flush()
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+
+    def _truncate_line(self):
+        with open(self._filename, 'r+b') as fp:
+            size = fp.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - TAIL_READ_SIZE)
+                fp.seek(start)
+                index = fp.read(end - start).rfind(b'\n')
+                if index >= 0:
+                    end = start + index + 1
+                    break
+                end = start
+            if end < size:
+                logger.debug(f'journal {self._filename} removing {size - end} bytes of a cut short line')
+                fp.truncate(end)
+
+    def _start_flush(self):
+        self._stop_event.clear()
+        if self._flush_interval and not self._flush_thread:
+            self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flush_thread.start()
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self._flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning(f'cannot write journal {self._filename}: {e}')
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def record_count(self):
+        """
+        Number of records written by this run.
+        """
+        return self._record_count
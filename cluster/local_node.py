@@ -0,0 +1,70 @@
+"""
+
+Local Node Class
+
+A node that runs its workers as local processes, so that a cluster can be
+run on one machine without ssh or rsync.
+
+"""
+
+import getpass
+import logging
+import os
+import subprocess
+import sys
+
+from cluster.node import Node
+
+LOCAL_HOSTNAME = 'localhost'
+# ports between the local nodes, so that the ports of each app do not run into the ports of the next app
+LOCAL_PORT_STRIDE = 100
+
+logger = logging.getLogger(__name__)
+
+class LocalNode(Node):
+
+    def __init__(self, index, name, worker_path, port_offset=0):
+        super().__init__(index, name, LOCAL_HOSTNAME, getpass.getuser(), '', worker_path)
+        self._port_offset = port_offset
+
+    def ssh_command(self):
+        return []
+
+    def ssh_line(self, command):
+        return ['sh', '-c', command]
+
+    def start_line(self, source_path, app_name, port):
+        # the worker app is run from where it is, so there is nothing to sync
+        return [sys.executable, os.path.join(source_path, app_name), '--port', str(port)]
+
+    def worker_port(self, port):
+        return port + self._port_offset
+
+    def execute(self, command):
+        logger.debug(f'local {command}')
+        p = subprocess.Popen(self.ssh_line(command), stdout=subprocess.PIPE)
+        out = p.stdout.read()
+        return out.decode()
+
+    def sync(self, source_path, force=False, manifest=None):
+        return ''
+
+    def sync_files(self, source_path, manifest):
+        return []
+
+    def sync_done(self, source_path, manifest):
+        pass
+
+    def sync_line(self, source_path, files_from=None):
+        return ['true']
+
+    @property
+    def is_local(self):
+        return True
+
+    @property
+    def port_offset(self):
+        return self._port_offset
+
+    def __str__(self):
+        return f'{self.name} local'
@@ -0,0 +1,125 @@
+"""
+
+Manifest Cache
+
+Keeps the content hash of each file in a worker path, and a record of the
+hashes that each node was last sent, so that a sync only needs to send the
+files that have changed.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+DEFAULT_CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'cluster-py')
+IGNORE_FOLDERS = ['__pycache__']
+IGNORE_EXTENSIONS = ['.pyc', '.pyo']
+HASH_BLOCK_SIZE = 0x10000
+
+logger = logging.getLogger(__name__)
+
+
+def save_json(filename, data, indent=None):
+    """
+    Write `data` as json to a temporary file and move it over `filename`, so that a
+    reader never sees a half written file. Each call has a temporary file of its own,
+    so that threads can save the same file at the same time.
+    """
+    folder = os.path.dirname(filename)
+    os.makedirs(folder, exist_ok=True)
+    handle, temp_filename = tempfile.mkstemp(dir=folder, prefix=f'{os.path.basename(filename)}.')
+    try:
+        with os.fdopen(handle, 'w') as fp:
+            json.dump(data, fp, indent=indent)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+def file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        data = fp.read(HASH_BLOCK_SIZE)
+        while data:
+            digest.update(data)
+            data = fp.read(HASH_BLOCK_SIZE)
+    return digest.hexdigest()
+
+
+class ManifestCache:
+
+    def __init__(self, cache_folder=DEFAULT_CACHE_FOLDER):
+        self._cache_folder = cache_folder
+
+    def build(self, source_path):
+        """
+        Return a dict of relative filename to content hash for all of the files in `source_path`.
+        Files with the same size and modified time as the last build are not hashed again.
+        """
+        local_filename = self._cache_filename('local', source_path)
+        last_files = self._load(local_filename).get('files', {})
+        files = {}
+        manifest = {}
+        for folder, folder_list, filename_list in os.walk(source_path):
+            folder_list[:] = sorted(name for name in folder_list if name not in IGNORE_FOLDERS)
+            for filename in sorted(filename_list):
+                if os.path.splitext(filename)[1] in IGNORE_EXTENSIONS:
+                    continue
+                full_filename = os.path.join(folder, filename)
+                name = os.path.relpath(full_filename, source_path)
+                stat = os.stat(full_filename)
+                item = last_files.get(name)
+                if not item or item['size'] != stat.st_size or item['mtime'] != stat.st_mtime:
+                    item = {
+                        'size': stat.st_size,
+                        'mtime': stat.st_mtime,
+                        'hash': file_hash(full_filename)
+                    }
+                files[name] = item
+                manifest[name] = item['hash']
+        if files != last_files:
+            self._save(local_filename, {'files': files})
+        return manifest
+
+    def changed_files(self, node, source_path, manifest):
+        """
+        Return the list of files in `manifest` that are different from the ones last sent to the node.
+        """
+        data = self._load(self._cache_filename(node.username_hostname, source_path))
+        last_manifest = data.get('manifest', {})
+        return [name for name, value in manifest.items() if last_manifest.get(name) != value]
+
+    def update(self, node, source_path, manifest):
+        self._save(self._cache_filename(node.username_hostname, source_path), {'manifest': manifest})
+
+    def clear(self, node, source_path):
+        filename = self._cache_filename(node.username_hostname, source_path)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def _cache_filename(self, name, source_path):
+        key = hashlib.sha1(f'{name}:{os.path.abspath(source_path)}'.encode()).hexdigest()
+        return os.path.join(self._cache_folder, f'{key}.json')
+
+    def _load(self, filename):
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as fp:
+                    return json.load(fp)
+            except ValueError as e:
+                logger.debug(f'cannot read manifest {filename}: {e}')
+        return {}
+
+    def _save(self, filename, data):
+        save_json(filename, data)
+
+    @property
+    def cache_folder(self):
+        return self._cache_folder
+
+
+manifest_cache = ManifestCache()
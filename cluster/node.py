@@ -5,49 +5,142 @@ Node Class
 """
 
 import logging
+import shlex
 import subprocess
+import tempfile
 import os
 
+from cluster.manifest import manifest_cache as default_manifest_cache
+from cluster.session import session_pool as default_session_pool
+
 logger = logging.getLogger(__name__)
 
 class Node:
 
-    def __init__(self, index, name, hostname, username, key_file, worker_path):
+    def __init__(self, index, name, hostname, username, key_file, worker_path, session_pool=None, manifest_cache=None):
         self._index = index
         self._name = name
         self._hostname = hostname
         self._username = username
         self._key_file = os.path.expandvars(key_file)
         self._worker_path = worker_path
+        self._session_pool = session_pool or default_session_pool
+        self._manifest_cache = manifest_cache or default_manifest_cache
 
-    def execute(self, command):
-        logger.debug(f'ssh {self.hostname} {command}')
-        line = ['ssh',
+    def ssh_command(self):
+        return ['ssh',
             '-i',
             self.key_file,
+        ] + self._session_pool.options(self)
+
+    def ssh_line(self, command):
+        return self.ssh_command() + [
             self.username_hostname,
             command
         ]
+
+    def start_line(self, source_path, app_name, port):
+        """
+        Return the command line to start the worker app from the node's worker path.
+        """
+        command = os.path.join(self.worker_path, app_name)
+        return self.ssh_line(f'{command} --port {port}')
+
+    def worker_port(self, port):
+        return port
+
+    def execute(self, command):
+        logger.debug(f'ssh {self.hostname} {command}')
+        line = self.ssh_line(command)
         p = subprocess.Popen(line, stdout=subprocess.PIPE)
         out = p.stdout.read()
         return out.decode()
 
-    def sync(self, source_path):
+    def sync(self, source_path, force=False, manifest=None):
+        """
+        Send the files in `source_path` that have changed since the last sync to this node.
+        `manifest` is the `ManifestCache.build` of `source_path`, it is built here if it is None.
+        Returns the rsync output, or an empty string if nothing has changed.
+        """
+        if manifest is None:
+            manifest = self._manifest_cache.build(source_path)
+        if force or not manifest:
+            file_list = None
+        else:
+            file_list = self.sync_files(source_path, manifest)
+            if not file_list:
+                logger.debug(f'rsync {source_path} {self.hostname} no changes')
+                return ''
+
         logger.debug(f'rsync {source_path} {self.hostname}')
+        files_from = self.write_files_from(source_path, file_list)
+        try:
+            line = self.sync_line(source_path, files_from)
+            p = subprocess.Popen(line, stdout=subprocess.PIPE)
+            out = p.stdout.read()
+            if p.wait() == 0 and manifest:
+                self.sync_done(source_path, manifest)
+        finally:
+            if files_from:
+                os.remove(files_from)
+        return out.decode()
 
-        line = ['rsync',
+    def sync_files(self, source_path, manifest):
+        return self._manifest_cache.changed_files(self, source_path, manifest)
+
+    def sync_done(self, source_path, manifest):
+        self._manifest_cache.update(self, source_path, manifest)
+
+    def sync_line(self, source_path, files_from=None):
+        if files_from:
+            # with a file list rsync needs the folder that the listed names are relative to
+            line = ['rsync',
+                '--archive',
+                '--verbose',
+                f'--files-from={files_from}',
+                '--rsh',
+                ' '.join(shlex.quote(item) for item in self.ssh_command()),
+                self.sync_base_path(source_path),
+                f'{self.username_hostname}:'
+            ]
+            return line
+
+        return ['rsync',
             '--archive',
             '--recursive',
             '--verbose',
             # '--delete',
             '--rsh',
-            f'ssh -i {self.key_file}',
+            ' '.join(shlex.quote(item) for item in self.ssh_command()),
             source_path,
             f'{self.username_hostname}:'
         ]
-        p = subprocess.Popen(line, stdout=subprocess.PIPE)
-        out = p.stdout.read()
-        return out.decode()
+
+    @staticmethod
+    def sync_base_path(source_path):
+        if source_path.endswith(os.sep):
+            return source_path
+        return os.path.dirname(os.path.abspath(source_path))
+
+    @staticmethod
+    def write_files_from(source_path, file_list):
+        """
+        Write the file list for `rsync --files-from`, relative to `sync_base_path`.
+        Returns the temporary filename, or None if all files are to be sent.
+        """
+        if file_list is None:
+            return None
+        prefix = ''
+        if not source_path.endswith(os.sep):
+            prefix = os.path.basename(os.path.abspath(source_path))
+        with tempfile.NamedTemporaryFile('w', prefix='cluster-sync-', delete=False) as fp:
+            for name in file_list:
+                fp.write(os.path.join(prefix, name) + '\n')
+        return fp.name
+
+    @property
+    def is_local(self):
+        return False
 
     @property
     def index(self):
@@ -0,0 +1,135 @@
+"""
+
+Node Profiler
+
+Works out a relative speed score for each node the first time the controller
+connects to it, from a short calibration run on the worker together with the
+cpu count, speed and architecture. The profiles are cached, so later runs do
+not need to calibrate again.
+
+The score only sets the size of the first blocks sent to each node. With a
+target duration, the block tuner of each node then sizes its blocks from the
+speed it measures.
+
+"""
+
+import json
+import logging
+import os
+
+from cluster.manifest import (
+    DEFAULT_CACHE_FOLDER,
+    save_json
+)
+
+DEFAULT_CALIBRATE_LOOP_COUNT = 200000
+PROFILE_FILENAME = 'profiles.json'
+
+# rough speed per hz of each architecture, used when a worker cannot calibrate
+ARCH_FACTORS = {
+    'X86_64': 1.0,
+    'X86_32': 0.8,
+    'ARM_8': 0.5,
+    'ARM_7': 0.3,
+}
+DEFAULT_ARCH_FACTOR = 0.5
+# used when nothing is known about the cpu speed
+DEFAULT_HZ = 1000000000
+# cpu cycles for one calibrate loop on X86_64, so that a score from the cpu speed is in calibrate loops
+HZ_PER_CALIBRATE_LOOP = 250
+# share of the calibrated speed in the score, the rest is the speed expected from the cpu speed and
+# architecture, which evens out a calibration run slowed down by something else on the node
+CALIBRATE_SHARE = 0.75
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+
+    def __init__(self, cache_folder=DEFAULT_CACHE_FOLDER, loop_count=DEFAULT_CALIBRATE_LOOP_COUNT):
+        self._cache_folder = cache_folder
+        self._loop_count = loop_count
+        self._profiles = None
+
+    def profile(self, worker, connection, refresh=False):
+        """
+        Return the profile of the worker's node as a dict, calibrating the node if it has not been seen before.
+        The connection is only used if the node is not in the cache or `refresh` is True.
+        """
+        key = worker.node.username_hostname
+        profiles = self._load()
+        if key in profiles and not refresh:
+            return profiles[key]
+
+        arch, count, hz = None, None, None
+        try:
+            arch, count, hz = connection.root.get_cpu_info()
+        except Exception as e:
+            logger.debug(f'{worker.node.name} no cpu info: {e}')
+            try:
+                count = connection.root.get_cpu_count()
+            except Exception as e:
+                logger.debug(f'{worker.node.name} no cpu count: {e}')
+        count = count or 1
+
+        calibrate_rate = None
+        try:
+            duration = connection.root.calibrate(self._loop_count)
+            calibrate_rate = self._loop_count / max(duration, 1e-9)
+        except Exception as e:
+            logger.debug(f'{worker.node.name} cannot calibrate: {e}')
+
+        item = {
+            'arch': arch,
+            'count': count,
+            'hz': hz,
+            'calibrate_rate': calibrate_rate,
+            'score': self.score(arch, count, hz, calibrate_rate),
+        }
+        logger.debug(f'{worker.node.name} profile {item}')
+        profiles[key] = item
+        self._save(profiles)
+        return item
+
+    @staticmethod
+    def score(arch, count, hz, calibrate_rate):
+        """
+        Return the speed of a node in calibrate loops per second over all of its cores. The
+        calibrated speed of one core and the speed expected from `hz` and `arch` are combined
+        as a weighted geometric mean, and either one is used alone if the other is not known.
+        """
+        hz_rate = (hz or DEFAULT_HZ) * ARCH_FACTORS.get(arch, DEFAULT_ARCH_FACTOR) / HZ_PER_CALIBRATE_LOOP
+        if calibrate_rate and hz:
+            rate = (calibrate_rate ** CALIBRATE_SHARE) * (hz_rate ** (1 - CALIBRATE_SHARE))
+        else:
+            rate = calibrate_rate or hz_rate
+        return rate * count
+
+    @staticmethod
+    def weights(profile_list):
+        """
+        Return the score of each profile relative to the fastest one.
+        """
+        max_score = max([item['score'] for item in profile_list] or [0])
+        if not max_score:
+            return [1.0 for item in profile_list]
+        return [item['score'] / max_score for item in profile_list]
+
+    def _load(self):
+        if self._profiles is None:
+            self._profiles = {}
+            filename = os.path.join(self._cache_folder, PROFILE_FILENAME)
+            if os.path.exists(filename):
+                try:
+                    with open(filename, 'r') as fp:
+                        self._profiles = json.load(fp)
+                except ValueError as e:
+                    logger.debug(f'cannot read profiles {filename}: {e}')
+        return self._profiles
+
+    def _save(self, profiles):
+        save_json(os.path.join(self._cache_folder, PROFILE_FILENAME), profiles, indent=2)
+
+    @property
+    def cache_folder(self):
+        return self._cache_folder
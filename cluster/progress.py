@@ -0,0 +1,170 @@
+"""
+
+Progress
+
+Channel for finished task events. The scheduler threads push an event for
+each finished task onto a queue, and one reader thread takes them off and
+shows the progress, the items per second of each node and overall, and the
+time left, at a fixed refresh rate. The reader sleeps on the queue between
+events, so nothing polls.
+
+"""
+
+import logging
+import queue
+import sys
+import threading
+import time
+
+from collections import deque
+
+DEFAULT_REFRESH_INTERVAL = 1.0
+# seconds of recent events used for the current rate and the time left
+RATE_WINDOW = 10.0
+
+logger = logging.getLogger(__name__)
+
+
+def format_count(value):
+    for limit, suffix in ((1e9, 'G'), (1e6, 'M'), (1e3, 'k')):
+        if value >= limit:
+            return f'{value / limit:0.1f}{suffix}'
+    return f'{value:0.0f}'
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+class Progress:
+
+    def __init__(self, total, done_size=0, refresh_interval=DEFAULT_REFRESH_INTERVAL, output=None, on_event=None):
+        """
+        :param total: number of items in the whole job.
+        :param done_size: number of items already done before this run, such as on resume.
+        :param output: function(text) to show the progress line, by default written to stdout.
+        :param on_event: optional function(progress) called by the reader thread after each event.
+        """
+        self._total = total
+        self._done_size = done_size
+        self._start_size = done_size
+        self._refresh_interval = refresh_interval
+        self._output = output or self._write
+        self._on_event = on_event
+        self._queue = queue.Queue()
+        self._node_sizes = {}
+        self._window = deque()
+        self._window_size = 0
+        self._start_time = None
+        self._line_length = 0
+        self._thread = None
+
+    def start(self):
+        self._start_time = time.time()
+        self._thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._thread.start()
+
+    def event(self, name, size):
+        """
+        Record that a task of `size` items has finished on the node `name`, called from any thread.
+        """
+        self._queue.put((name, size, time.time()))
+
+    def close(self):
+        """
+        Stop the reader once it has taken all of the events, and clear the progress line.
+        """
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._line_length:
+            self._output('\r' + ' ' * self._line_length + '\r')
+            self._line_length = 0
+
+    def _read_loop(self):
+        next_time = self._start_time + self._refresh_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0, next_time - time.time()))
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                self._add(*item)
+                if self._on_event:
+                    try:
+                        self._on_event(self)
+                    except Exception as e:
+                        logger.warning(f'progress event error: {e}')
+            if time.time() >= next_time:
+                self._render()
+                next_time = time.time() + self._refresh_interval
+
+    def _add(self, name, size, event_time):
+        self._done_size += size
+        self._node_sizes[name] = self._node_sizes.get(name, 0) + size
+        self._window.append((event_time, size))
+        self._window_size += size
+        while self._window and self._window[0][0] < event_time - RATE_WINDOW:
+            self._window_size -= self._window.popleft()[1]
+
+    def _render(self):
+        if self._done_size <= self._start_size:
+            return
+        percent_done = (self._done_size / self._total) * 100 if self._total else 100
+        text = f'{percent_done:0.1f}% {format_count(self.rate)}/s'
+        rate = self.recent_rate
+        if rate:
+            text += f' ETA {format_duration(max(0, self._total - self._done_size) / rate)}'
+        if len(self._node_sizes) > 1:
+            text += ' [' + ', '.join(f'{name} {format_count(value)}/s' for name, value in self.node_rates.items()) + ']'
+        self._output('\r' + text.ljust(self._line_length))
+        self._line_length = len(text)
+
+    def _write(self, text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    def summary(self):
+        """
+        Return a line with the items per second of each node and overall for this run.
+        """
+        text = ', '.join(f'{name} {format_count(value)}/s' for name, value in self.node_rates.items())
+        return f'{format_count(self.rate)}/s overall ({text})'
+
+    @property
+    def done_size(self):
+        return self._done_size
+
+    @property
+    def elapsed(self):
+        return time.time() - self._start_time if self._start_time else 0
+
+    @property
+    def rate(self):
+        """
+        Items per second over the whole of this run.
+        """
+        return (self._done_size - self._start_size) / max(self.elapsed, 1e-9)
+
+    @property
+    def recent_rate(self):
+        """
+        Items per second over the last few seconds, None until there are events to measure.
+        """
+        if not self._window:
+            return None
+        duration = min(RATE_WINDOW, self.elapsed)
+        return self._window_size / max(duration, 1e-9)
+
+    @property
+    def node_rates(self):
+        elapsed = max(self.elapsed, 1e-9)
+        return {name: value / elapsed for name, value in sorted(self._node_sizes.items())}
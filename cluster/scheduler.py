@@ -0,0 +1,646 @@
+"""
+
+Scheduler
+
+Sends tasks to workers and passes the results back to a reduce callback.
+With a `partial` factory each dispatch thread reduces into a partial result
+of its own without taking a lock, and the partials are merged pairwise at
+the end by `tree_reduce`.
+Each worker takes a few tasks at a time from the task source into its own
+queue, and once the source is empty an idle worker steals the last queued
+task from the worker with the most tasks left.
+
+The task source can be any iterable, or a `RangeCursor` or `GapCursor`, in
+which case each worker is sent (from, to) ranges sized by its own `BlockTuner`.
+
+"""
+
+import bisect
+import logging
+import math
+import rpyc
+import threading
+import time
+import weakref
+
+from collections import deque
+
+from cluster.profiler import Profiler
+from cluster.tuner import BlockTuner
+
+DEFAULT_PREFETCH = 2
+# slots for each core of a worker when each task has a connection of its own
+CPU_COUNT_FACTOR = 4
+# most tasks and starting number of tasks in flight on a pipelined worker, which splits each task over its cores
+PIPELINE_DEPTH = 4
+PIPELINE_START_DEPTH = 2
+DEFAULT_BLOCK_SIZE = 10000
+# seconds a dispatch thread waits after a failed task, doubled for each failure in a row
+FAIL_RETRY_DELAY = 0.5
+FAIL_RETRY_MAX_DELAY = 8.0
+# failures in a row before a dispatch thread stops using its worker
+MAX_FAIL_COUNT = 5
+# smallest block at the end of a range, as a fraction of the tuned block size
+TAIL_MIN_FRACTION = 8
+
+logger = logging.getLogger(__name__)
+
+
+class RangeCursor:
+
+    def __init__(self, start, stop):
+        self._start = start
+        self._stop = stop
+        self._position = start
+        self._lock = threading.Lock()
+
+    def take(self, size):
+        """
+        Return the next (from, to) range of up to `size` items, or None when the range is used up.
+        """
+        with self._lock:
+            if self._position >= self._stop:
+                return None
+            from_number = self._position
+            self._position = min(from_number + max(1, size), self._stop)
+            return (from_number, self._position)
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def stop(self):
+        return self._stop
+
+    @property
+    def position(self):
+        return self._position
+
+    @property
+    def remaining(self):
+        return self._stop - self._position
+
+
+class RangeSet:
+    """
+    Sorted list of disjoint (from, to) ranges, where ranges that touch or overlap are joined
+    as they are added. Ranges that are mostly added in order, such as the finished blocks of
+    a job, are joined onto the last range, so the set only grows with the number of gaps.
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._stops = []
+        self._size = 0
+
+    def add(self, from_number, to_number):
+        if to_number <= from_number:
+            return
+        # the first range that ends at or after from_number, and the first one that starts after to_number
+        low = bisect.bisect_left(self._stops, from_number)
+        high = bisect.bisect_right(self._starts, to_number)
+        if low < high:
+            from_number = min(from_number, self._starts[low])
+            to_number = max(to_number, self._stops[high - 1])
+            self._size -= sum(self._stops[index] - self._starts[index] for index in range(low, high))
+        self._starts[low:high] = [from_number]
+        self._stops[low:high] = [to_number]
+        self._size += to_number - from_number
+
+    def __iter__(self):
+        return zip(self._starts, self._stops)
+
+    def __len__(self):
+        return len(self._starts)
+
+    @property
+    def size(self):
+        """
+        Number of items in all of the ranges.
+        """
+        return self._size
+
+
+class GapCursor:
+    """
+    Range cursor over the parts of start to stop that are not in the sorted disjoint `done_ranges`,
+    such as a `RangeSet` of the ranges already finished by an earlier run of a job. The gaps are
+    worked out one at a time as the cursor gets to them.
+    """
+
+    def __init__(self, start, stop, done_ranges):
+        self._start = start
+        self._stop = stop
+        self._done_iter = iter(done_ranges)
+        self._position = start
+        self._gap_stop = start
+        self._skip_to = None
+        done_size = sum(max(0, min(to_number, stop) - max(from_number, start)) for from_number, to_number in done_ranges)
+        self._remaining = max(0, stop - start - done_size)
+        self._lock = threading.Lock()
+
+    def take(self, size):
+        """
+        Return the next (from, to) range of up to `size` items, or None when all of the gaps are used up.
+        """
+        with self._lock:
+            if self._position >= self._gap_stop and not self._next_gap():
+                return None
+            from_number = self._position
+            self._position = min(from_number + max(1, size), self._gap_stop)
+            self._remaining -= self._position - from_number
+            return (from_number, self._position)
+
+    def _next_gap(self):
+        # step over the finished range at the end of the last gap
+        if self._skip_to is not None:
+            self._position = max(self._position, self._skip_to)
+            self._skip_to = None
+        while self._position < self._stop:
+            done_range = next(self._done_iter, None)
+            if done_range is None:
+                self._gap_stop = self._stop
+                return True
+            if done_range[0] > self._position:
+                self._gap_stop = min(done_range[0], self._stop)
+                self._skip_to = done_range[1]
+                return True
+            self._position = max(self._position, done_range[1])
+        return False
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def stop(self):
+        return self._stop
+
+    @property
+    def remaining(self):
+        return self._remaining
+
+
+_async_methods = weakref.WeakKeyDictionary()
+
+
+def async_method(connection, name):
+    """
+    Return the async version of the remote root method `name`. It is kept for each connection,
+    since looking up a remote attribute is a round trip of its own.
+    """
+    methods = _async_methods.setdefault(connection, {})
+    if name not in methods:
+        methods[name] = rpyc.async_(getattr(connection.root, name))
+    return methods[name]
+
+
+def tree_reduce(item_list, merge):
+    """
+    Merge the items in pairs, then the pairs in pairs, until there is one left.
+    Returns None if there are no items.
+    """
+    item_list = list(item_list)
+    if not item_list:
+        return None
+    while len(item_list) > 1:
+        merged_list = [merge(item_list[index], item_list[index + 1]) for index in range(0, len(item_list) - 1, 2)]
+        if len(item_list) % 2:
+            merged_list.append(item_list[-1])
+        item_list = merged_list
+    return item_list[0]
+
+
+class PartialResult:
+    """
+    Counts and partial result of one dispatch thread, only ever written by that thread.
+    """
+
+    def __init__(self, value=None):
+        self.done_count = 0
+        self.done_size = 0
+        self.value = value
+
+
+def task_size(task):
+    if isinstance(task, tuple) and len(task) == 2:
+        return task[1] - task[0]
+    return 1
+
+
+class Scheduler:
+
+    def __init__(self, manager, call, reduce=None, prefetch=DEFAULT_PREFETCH,
+                 block_size=DEFAULT_BLOCK_SIZE, target_duration=None, granularity=1, pipeline=False,
+                 partial=None, merge=None, progress=None):
+        """
+        :param manager: `ConnectionManager` to borrow the worker connections from.
+        :param call: function(connection, task) that runs the task on a worker and returns the result.
+        :param reduce: function(worker, task, result) called for each result, one at a time.
+            If `partial` is set, it is function(value, task, result) instead, and returns the new partial value.
+            If it raises, the task has failed and is sent out again.
+        :param prefetch: number of tasks each worker takes from the task source at a time.
+        :param block_size: starting size of a range task.
+        :param target_duration: if set, the block size and number of tasks in flight on each worker
+            are tuned so that each task takes about this many seconds.
+        :param granularity: range tasks are sized in multiples of this.
+        :param pipeline: if True, each worker is sent tasks from one thread over one connection, and
+            `call` returns an rpyc async result, so that up to the depth of tasks are in flight at a time.
+        :param partial: function() that returns the starting partial value for each dispatch thread.
+        :param merge: function(value, value) that merges two partial values into one, for `result`.
+        :param progress: optional `Progress` that is sent an event for each finished task.
+        """
+        self._manager = manager
+        self._call = call
+        self._reduce = reduce
+        self._prefetch = prefetch
+        self._block_size = block_size
+        self._target_duration = target_duration
+        self._granularity = granularity
+        self._pipeline = pipeline
+        self._partial = partial
+        self._merge = merge
+        self._progress = progress
+        self._partials = []
+        self._workers = []
+        self._queues = {}
+        self._tuners = {}
+        self._conditions = {}
+        self._retry_queue = deque()
+        # keys of the workers that have failed too many times in a row
+        self._failed_keys = set()
+        self._task_iter = None
+        self._cursor = None
+        self._thread_list = []
+        self._lock = threading.Lock()
+        self._reduce_lock = threading.Lock()
+        self._done_event = threading.Event()
+        self._is_stopped = False
+        self._active_count = 0
+        self._inflight_count = 0
+        self._steal_count = 0
+
+    def add_worker(self, worker, slot_count=1, depth=None, weight=1.0):
+        """
+        Add a worker, with up to `slot_count` tasks running or in flight on it at the same time.
+        `depth` is the number of tasks in flight to start with, by default `slot_count`.
+        `weight` is the speed of the worker relative to the fastest one, and sizes its first range tasks.
+        With a `target_duration` it is only a starting point, and the worker's `BlockTuner` sizes the
+        tasks after that from the speed it measures.
+        """
+        key = self.key(worker)
+        self._workers.append((worker, slot_count))
+        self._queues[key] = deque()
+        self._conditions[key] = threading.Condition(self._lock)
+        self._tuners[key] = BlockTuner(
+            int(self._block_size * weight),
+            depth or slot_count,
+            slot_count,
+            self._target_duration,
+            granularity=self._granularity
+        )
+
+    def add_workers(self, worker_list, connection_list, refresh_profile=False):
+        """
+        Add each worker that has a connection in `connection_list`, as returned by `startup_workers`,
+        with a weight from the profile of its node. Returns the workers that have no connection.
+        """
+        profiler = Profiler()
+        profile_list = []
+        missing_list = []
+        for worker, connection in zip(worker_list, connection_list):
+            if not connection:
+                missing_list.append(worker)
+                continue
+            self._manager.add(worker, connection)
+            with self._manager.borrow(worker) as connection:
+                profile_list.append((worker, profiler.profile(worker, connection, refresh_profile)))
+
+        weights = Profiler.weights([profile for worker, profile in profile_list])
+        for (worker, profile), weight in zip(profile_list, weights):
+            cpu_count = profile['count']
+            logger.debug(f'start {worker.node.name} {cpu_count} weight {weight:0.2f}')
+            if self._pipeline:
+                self.add_worker(worker, PIPELINE_DEPTH, PIPELINE_START_DEPTH, weight)
+            else:
+                self.add_worker(worker, cpu_count * CPU_COUNT_FACTOR, cpu_count, weight)
+        return missing_list
+
+    def start(self, tasks):
+        if hasattr(tasks, 'take'):
+            self._cursor = tasks
+            self._task_iter = None
+        else:
+            self._cursor = None
+            self._task_iter = iter(tasks)
+        self._done_event.clear()
+        self._is_stopped = False
+        for worker, slot_count in self._workers:
+            if self._pipeline:
+                thread = threading.Thread(target=self._pipeline_thread, args=(worker, ), daemon=True)
+                self._thread_list.append(thread)
+                continue
+            for index in range(slot_count):
+                thread = threading.Thread(target=self._slot_thread, args=(worker, index), daemon=True)
+                self._thread_list.append(thread)
+        self._active_count = len(self._thread_list)
+        if not self._thread_list:
+            self._done_event.set()
+        for thread in self._thread_list:
+            thread.start()
+
+    def join(self, timeout=None):
+        """
+        Wait for all of the tasks to finish, returns False if `timeout` seconds have passed first.
+        """
+        return self._done_event.wait(timeout)
+
+    def run(self, tasks):
+        self.start(tasks)
+        self.join()
+
+    def stop(self):
+        """
+        Stop sending out new tasks, the tasks already running are still reduced.
+        """
+        with self._lock:
+            self._is_stopped = True
+            self._notify_all()
+
+    @staticmethod
+    def key(worker):
+        return (worker.node.hostname, worker.port)
+
+    def tuner(self, worker):
+        return self._tuners[self.key(worker)]
+
+    def next_task(self, worker, index=0, wait=True):
+        """
+        Return the next task for the worker, or None if there are no more tasks.
+        Slot `index` waits here while it is above the number of tasks in flight for the worker.
+        If there are no tasks left but some are still running, and `wait` is True, this waits
+        for them to finish, since a task that fails is sent out again.
+        """
+        key = self.key(worker)
+        with self._lock:
+            tuner = self._tuners[key]
+            condition = self._conditions[key]
+            while not self._is_stopped and key not in self._failed_keys:
+                if index >= tuner.depth and self._has_tasks():
+                    condition.wait()
+                    continue
+                task = self._take(key, tuner)
+                if task is not None:
+                    self._inflight_count += 1
+                    return task
+                if not wait or not self._inflight_count:
+                    break
+                condition.wait()
+            return None
+
+    def _take(self, key, tuner):
+        if self._retry_queue:
+            return self._retry_queue.popleft()
+        task_queue = self._queues[key]
+        if not task_queue:
+            self._fill(task_queue, tuner)
+        if not task_queue:
+            return self._steal()
+        return task_queue.popleft()
+
+    def _has_tasks(self):
+        if self._retry_queue or any(self._queues.values()):
+            return True
+        if self._cursor:
+            return self._cursor.remaining > 0
+        return self._task_iter is not None
+
+    def _fill(self, task_queue, tuner):
+        for index in range(self._prefetch):
+            if self._cursor:
+                task = self._cursor.take(self._range_size(tuner))
+            else:
+                task = self._next_item()
+            if task is None:
+                break
+            task_queue.append(task)
+
+    def _next_item(self):
+        if self._task_iter is None:
+            return None
+        try:
+            return next(self._task_iter)
+        except StopIteration:
+            self._task_iter = None
+        return None
+
+    def _range_size(self, tuner):
+        size = tuner.block_size
+        # near the end share out what is left, so that the workers finish at about the same time
+        round_size = sum(item.block_size * item.depth for item in self._tuners.values())
+        remaining = self._cursor.remaining
+        if remaining < round_size * self._prefetch:
+            share = (tuner.block_size * tuner.depth) / round_size
+            tail_size = math.ceil(remaining * share / tuner.depth)
+            size = tuner.align(max(tail_size, size // TAIL_MIN_FRACTION))
+        return size
+
+    def _steal(self):
+        busy_queue = max(self._queues.values(), key=len)
+        if busy_queue:
+            self._steal_count += 1
+            return busy_queue.pop()
+        return None
+
+    def _notify_all(self):
+        for condition in self._conditions.values():
+            condition.notify_all()
+
+    def _new_partial(self):
+        partial_result = PartialResult(self._partial() if self._partial else None)
+        with self._lock:
+            self._partials.append(partial_result)
+        return partial_result
+
+    def _slot_thread(self, worker, index):
+        partial_result = self._new_partial()
+        fail_count = 0
+        try:
+            while True:
+                task = self.next_task(worker, index)
+                if task is None:
+                    break
+                start_time = time.time()
+                try:
+                    # the manager closes a connection that fails, so the next borrow gets a new one
+                    with self._manager.borrow(worker) as connection:
+                        result = self._call(connection, task)
+                        # a result that cannot be reduced fails the task as well
+                        self._task_done(worker, task, result, time.time() - start_time, partial_result)
+                except Exception as e:
+                    # give the task to any slot, and wait a while before trying this worker again
+                    self._task_failed(worker, [task], e)
+                    fail_count += 1
+                    if not self._fail_wait(worker, fail_count):
+                        break
+                    continue
+                fail_count = 0
+        finally:
+            self._slot_done()
+
+    def _fail_wait(self, worker, fail_count):
+        """
+        Wait before trying the worker again after `fail_count` failures in a row.
+        Returns False if the worker has failed too many times and should not be used again.
+        """
+        if fail_count >= MAX_FAIL_COUNT:
+            logger.warning(f'{worker.node.name} failed {fail_count} times in a row, no longer sending it tasks')
+            with self._lock:
+                # stop the other slots of the worker as well, they may be waiting for a turn
+                self._failed_keys.add(self.key(worker))
+                self._notify_all()
+            return False
+        delay = min(FAIL_RETRY_DELAY * (2 ** (fail_count - 1)), FAIL_RETRY_MAX_DELAY)
+        end_time = time.time() + delay
+        with self._lock:
+            while not self._is_stopped and time.time() < end_time:
+                self._conditions[self.key(worker)].wait(end_time - time.time())
+        return True
+
+    def _pipeline_thread(self, worker):
+        """
+        Keep up to the tuned depth of async requests in flight on one connection to the worker.
+        If the connection fails, the tasks in flight are sent out again and a new connection is
+        made, until the worker has failed too many times in a row.
+        """
+        tuner = self.tuner(worker)
+        partial_result = self._new_partial()
+        fail_count = 0
+        try:
+            while True:
+                connection = None
+                inflight = deque()
+                task = None
+                last_done_time = 0
+                try:
+                    connection = self._manager.acquire(worker)
+                    while True:
+                        while len(inflight) < tuner.depth:
+                            # only wait for the tasks of the other workers when none of this one's are in flight
+                            task = self.next_task(worker, wait=not inflight)
+                            if task is None:
+                                break
+                            inflight.append((task, time.time(), self._call(connection, task)))
+                        if not inflight:
+                            break
+                        task, send_time, async_result = inflight.popleft()
+                        result = async_result.value
+                        # the request may have been queued behind the ones before it, so time it from
+                        # when it was sent or when the one before it finished, whichever is later
+                        done_time = time.time()
+                        self._task_done(worker, task, result, done_time - max(send_time, last_done_time), partial_result)
+                        last_done_time = done_time
+                        task = None
+                        fail_count = 0
+                except Exception as e:
+                    task_list = [item[0] for item in inflight]
+                    if task is not None:
+                        task_list.insert(0, task)
+                    if task_list:
+                        self._task_failed(worker, task_list, e)
+                    else:
+                        logger.warning(f'{worker.node.name} cannot connect: {e}')
+                    if connection:
+                        self._manager.close(connection)
+                    fail_count += 1
+                    if not self._fail_wait(worker, fail_count):
+                        break
+                    continue
+                self._manager.release(worker, connection)
+                break
+        finally:
+            self._slot_done()
+
+    def _task_done(self, worker, task, result, duration, partial_result):
+        # reduce first, so that a task that reduce fails is not counted as done
+        if self._partial:
+            # only this thread writes to its partial result, so there is nothing to lock
+            partial_result.value = self._reduce(partial_result.value, task, result)
+        elif self._reduce:
+            with self._reduce_lock:
+                self._reduce(worker, task, result)
+        tuner = self.tuner(worker)
+        size = task_size(task)
+        depth = tuner.depth
+        tuner.record(size, duration)
+        if tuner.depth != depth:
+            with self._lock:
+                self._conditions[self.key(worker)].notify_all()
+        partial_result.done_size += size
+        partial_result.done_count += 1
+        if self._progress:
+            self._progress.event(worker.node.name, size)
+        with self._lock:
+            self._inflight_count -= 1
+            if not self._inflight_count:
+                # wake up the slots waiting in case this task failed
+                self._notify_all()
+
+    def _task_failed(self, worker, task_list, error):
+        logger.warning(f'{worker.node.name} failed task {task_list[0]}: {error}')
+        with self._lock:
+            self._inflight_count -= len(task_list)
+            self._retry_queue.extend(task_list)
+            self._notify_all()
+
+    def _slot_done(self):
+        with self._lock:
+            self._active_count -= 1
+            # wake up any waiting slots, so that they can see if there is anything left
+            self._notify_all()
+            if self._active_count == 0:
+                self._done_event.set()
+
+    def result(self):
+        """
+        Return the partial results of all of the dispatch threads merged into one, or the
+        starting partial value if no tasks were done.
+        """
+        value_list = self.partials
+        if not value_list:
+            return self._partial() if self._partial else None
+        return tree_reduce(value_list, self._merge)
+
+    @property
+    def partials(self):
+        """
+        Current partial value of each dispatch thread, can be read while the tasks are running.
+        """
+        return [item.value for item in list(self._partials)]
+
+    @property
+    def done_count(self):
+        return sum(item.done_count for item in list(self._partials))
+
+    @property
+    def done_size(self):
+        """
+        Number of items done, where a range task counts as the size of the range.
+        """
+        return sum(item.done_size for item in list(self._partials))
+
+    @property
+    def steal_count(self):
+        return self._steal_count
+
+    @property
+    def pending_count(self):
+        """
+        Number of tasks that have failed and are not yet sent again.
+        """
+        return len(self._retry_queue)
+
+    @property
+    def workers(self):
+        return [worker for worker, slot_count in self._workers]
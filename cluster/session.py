@@ -0,0 +1,103 @@
+"""
+
+SSH Session Pool
+
+Keeps one OpenSSH ControlMaster socket per node, so that `ssh` and `rsync`
+calls after the first one reuse the already authenticated connection.
+Each process keeps its sockets in a folder of its own, so that closing the
+masters at exit does not cut off the sessions of another controller.
+
+"""
+
+import atexit
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+DEFAULT_IDLE_TIMEOUT = 300
+
+logger = logging.getLogger(__name__)
+
+
+class SessionPool:
+
+    def __init__(self, control_folder=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self._is_own_folder = control_folder is None
+        if control_folder is None:
+            control_folder = os.path.join(tempfile.gettempdir(), f'cluster-py-{os.getuid()}', str(os.getpid()))
+        self._control_folder = control_folder
+        self._idle_timeout = idle_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        atexit.register(self.close_all)
+
+    def options(self, node):
+        """
+        Return the ssh options to multiplex a connection to the node.
+        The master connection is started by the first ssh call and stays open for
+        `idle_timeout` seconds after the last call has finished.
+        """
+        if not os.path.isdir(self._control_folder):
+            os.makedirs(self._control_folder, mode=0o700, exist_ok=True)
+        with self._lock:
+            self._sessions[node.username_hostname] = (node, time.time())
+        self.evict_idle()
+        return [
+            '-o', 'ControlMaster=auto',
+            '-o', f'ControlPath={self.control_path}',
+            '-o', f'ControlPersist={self._idle_timeout}',
+        ]
+
+    def evict_idle(self):
+        expire_time = time.time() - self._idle_timeout
+        with self._lock:
+            expired_list = [name for name, (node, used_time) in self._sessions.items() if used_time < expire_time]
+            for name in expired_list:
+                # the master has already exited by itself, so just forget about it
+                logger.debug(f'session idle {name}')
+                del self._sessions[name]
+
+    def close(self, node):
+        with self._lock:
+            self._sessions.pop(node.username_hostname, None)
+        line = ['ssh',
+            '-i',
+            node.key_file,
+            '-o', f'ControlPath={self.control_path}',
+            '-O', 'exit',
+            node.username_hostname
+        ]
+        logger.debug(f'close session {node.username_hostname}')
+        subprocess.run(line, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def close_all(self):
+        # forked processes share the masters of the parent, so only the parent closes them
+        if os.getpid() != self._pid:
+            return
+        with self._lock:
+            node_list = [node for node, used_time in self._sessions.values()]
+        for node in node_list:
+            self.close(node)
+        if self._is_own_folder:
+            shutil.rmtree(self._control_folder, ignore_errors=True)
+
+    @property
+    def control_path(self):
+        # %C is a hash of the connection details, short enough for the unix socket path limit
+        return os.path.join(self._control_folder, '%C')
+
+    @property
+    def control_folder(self):
+        return self._control_folder
+
+    @property
+    def idle_timeout(self):
+        return self._idle_timeout
+
+
+session_pool = SessionPool()
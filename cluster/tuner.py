@@ -0,0 +1,126 @@
+"""
+
+Block Tuner
+
+Measures the time each block takes on a node, and works out the block size
+and the number of blocks in flight that keep the node busy with blocks that
+take about `target_duration` seconds.
+
+"""
+
+import logging
+import threading
+import time
+
+DEFAULT_TARGET_DURATION = 0.2
+DEFAULT_MIN_BLOCK_SIZE = 1
+DEFAULT_MAX_BLOCK_SIZE = 100000000
+# weight of the last block in the moving average
+RATE_SMOOTHING = 0.3
+# number of blocks to measure the throughput before changing the depth
+DEPTH_WINDOW_FACTOR = 2
+# change in throughput that counts as better or worse
+DEPTH_THRESHOLD = 0.05
+# number of windows to hold the depth before trying one more block in flight
+DEPTH_HOLD_COUNT = 4
+
+logger = logging.getLogger(__name__)
+
+
+class BlockTuner:
+
+    def __init__(self, block_size, depth=1, max_depth=1, target_duration=DEFAULT_TARGET_DURATION,
+                 min_block_size=DEFAULT_MIN_BLOCK_SIZE, max_block_size=DEFAULT_MAX_BLOCK_SIZE, granularity=1):
+        self._depth = max(1, min(depth, max_depth))
+        self._max_depth = max_depth
+        self._target_duration = target_duration
+        self._min_block_size = min_block_size
+        self._max_block_size = max_block_size
+        self._granularity = granularity
+        self._block_size = self.align(block_size)
+        self._rate = None
+        self._lock = threading.Lock()
+        self._window_start_time = None
+        self._window_size = 0
+        self._window_count = 0
+        self._last_throughput = None
+        self._depth_step = 1
+        self._hold_count = 0
+
+    def record(self, size, duration):
+        """
+        Record a finished block of `size` items that took `duration` seconds.
+        """
+        with self._lock:
+            rate = size / max(duration, 1e-6)
+            if self._rate is None:
+                self._rate = rate
+            elif size * 2 >= self._block_size:
+                # much smaller blocks, such as the ones at the end of a range, are mostly overhead
+                self._rate = (RATE_SMOOTHING * rate) + ((1 - RATE_SMOOTHING) * self._rate)
+            if self._target_duration:
+                self._block_size = self.align(self._rate * self._target_duration)
+                self._update_depth(size)
+
+    def _update_depth(self, size):
+        now = time.time()
+        if self._window_start_time is None:
+            self._window_start_time = now
+            return
+        self._window_size += size
+        self._window_count += 1
+        if self._window_count < self._depth * DEPTH_WINDOW_FACTOR:
+            return
+        throughput = self._window_size / max(now - self._window_start_time, 1e-9)
+        if self._last_throughput is not None:
+            if throughput > self._last_throughput * (1 + DEPTH_THRESHOLD):
+                # keep going the same way while it gets better
+                self._depth_step = self._depth_step or 1
+            elif throughput < self._last_throughput * (1 - DEPTH_THRESHOLD):
+                # the last change made it worse, so go back the other way
+                self._depth_step = -self._depth_step or -1
+            elif self._depth_step > 0:
+                # one more block in flight did not help, so take it back and hold
+                self._depth_step = -1
+            elif self._depth_step < 0:
+                self._depth_step = 0
+            else:
+                self._hold_count += 1
+                if self._hold_count >= DEPTH_HOLD_COUNT:
+                    self._hold_count = 0
+                    self._depth_step = 1
+        new_depth = max(1, min(self._depth + self._depth_step, self._max_depth))
+        if new_depth != self._depth:
+            logger.debug(f'depth {self._depth} -> {new_depth} at {throughput:0.1f} items/s')
+        self._depth = new_depth
+        self._last_throughput = throughput
+        self._window_start_time = now
+        self._window_size = 0
+        self._window_count = 0
+
+    def align(self, size):
+        size = max(self._min_block_size, min(int(size), self._max_block_size))
+        return max(self._granularity, (size // self._granularity) * self._granularity)
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @property
+    def depth(self):
+        return self._depth
+
+    @property
+    def max_depth(self):
+        return self._max_depth
+
+    @property
+    def rate(self):
+        """
+        Moving average of items per second for one block in flight, None until the first block.
+        """
+        return self._rate
+
+    @property
+    def target_duration(self):
+        return self._target_duration
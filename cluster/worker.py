@@ -4,14 +4,30 @@ Worker Class
 
 """
 
+import atexit
 import logging
 import re
 import rpyc
+import select
+import shlex
 import subprocess
 import time
-import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cluster.manifest import manifest_cache
 
 CONNECTION_TIMEOUT = 10
+CONNECTION_RETRY_DELAY = 0.05
+CONNECTION_RETRY_MAX_DELAY = 1.0
+# number of 0.1 second waits for a killed worker app to exit
+KILL_WAIT_COUNT = 50
+# seconds to wait for a local worker app to exit when it is stopped
+STOP_TIMEOUT = 5
+
+# printed by the worker app once its server is listening
+WORKER_READY_TOKEN = 'worker ready'
+OUTPUT_READ_SIZE = 0x1000
 
 logger = logging.getLogger(__name__)
 
@@ -21,59 +37,159 @@ class Worker:
         self._node = node
         self._path = path
         self._app_name = app_name
-        self._port = port
+        self._port = node.worker_port(port)
+        # the worker app's rpyc service has the app name as its alias
+        self._service_name = app_name.split('.')[0].upper()
+        self._proc = None
 
     def start(self):
-        command = os.path.join(self._node.worker_path, self._app_name)
-        line = ['ssh',
-            '-i',
-            self._node.key_file,
-            self._node.username_hostname,
-            command
-        ]
-        logger.debug(f'ssh line: {" ".join(line)}')
-        proc = subprocess.Popen(line, stdout=subprocess.PIPE)
+        line = self._node.start_line(self._path, self._app_name, self._port)
+        logger.debug(f'start line: {" ".join(line)}')
+        # unbuffered, so that select sees all of the output that has not been read yet. The app
+        # does not share the stderr or the session of the controller, so that a pipe reading the
+        # output of the controller is not held open by the app, and ctrl-c does not reach it
+        proc = subprocess.Popen(
+            line,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=0,
+            start_new_session=True
+        )
         return proc
 
-    def connect(self, config={}):
+    def connect(self, config=None):
+        """
+        Return a new connection to the worker app, or None if it cannot connect.
+        Raises ConnectionError if another app is listening on the port.
+        """
         connection = None
         try:
-            connection = rpyc.connect(self._node.hostname, self._port, config=config)
+            connection = rpyc.connect(self._node.hostname, self._port, config=config or {})
             logger.debug(f'connected {self._node.hostname}')
         except Exception as e:
             logger.debug(f'connection error: {e}')
+            return None
+        try:
+            service_name = connection.root.get_service_name()
+        except Exception as e:
+            logger.debug(f'service name error: {e}')
+            connection.close()
+            return None
+        if service_name != self._service_name:
+            connection.close()
+            raise ConnectionError(
+                f'{self._node.hostname}:{self._port} is running {service_name} and not {self._service_name}, '
+                'stop it or use another port'
+            )
         return connection
 
-    def startup(self, is_restart=False, connection_timeout=CONNECTION_TIMEOUT):
+    def startup(self, is_restart=False, connection_timeout=CONNECTION_TIMEOUT, config=None, manifest=None):
+        """
+        Start the worker app if it is not already running, and return a connection to it made
+        with the rpyc `config`, or None if it cannot be started. On a restart the worker path is
+        synced to the node first, using `manifest` if it has already been built.
+        """
+        try:
+            return self._startup(is_restart, connection_timeout, config, manifest)
+        except ConnectionError as e:
+            logger.error(f'{self._node.name} {e}')
+        return None
+
+    def _startup(self, is_restart, connection_timeout, config, manifest):
         proc = None
         if is_restart:
             logger.debug(f'need to do restart so closing {self._node.hostname}');
             try:
-                line = f'pkill -f {self._app_name}'
-                self._node.execute(line)
+                self._node.execute(self.kill_command())
             except Exception as e:
                 logger.debug(f'close connection {e}')
 
             logger.debug(f'rsync worker path')
-            result = self._node.sync(self._path)
+            result = self._node.sync(self._path, manifest=manifest)
             logger.debug(f'sync output: {result}')
 
-        connection = self.connect()
+        connection = self.connect(config)
         if not connection:
             logger.debug(f'starting worker {self._node.hostname}...')
             proc = self.start()
 
-            timeout = time.time() + connection_timeout
-            logger.debug('waiting for connection')
-            while timeout > time.time():
-                connection = self.connect()
-                if connection:
-                    logger.debug('connected')
-                    break
-            if proc:
+            try:
+                connection = self.wait_for_connection(proc, connection_timeout, config)
+            except ConnectionError:
+                proc.kill()
+                raise
+            if self._node.is_local and connection:
+                # the proc is the worker itself, so leave it running until the controller exits
+                proc.stdout.close()
+                self._proc = proc
+                atexit.register(self.stop)
+            elif proc:
                 proc.kill()
         return connection 
 
+    def stop(self):
+        """
+        Stop the local worker app, if it was started by this worker.
+        """
+        proc = self._proc
+        self._proc = None
+        if proc is None or proc.poll() is not None:
+            return
+        logger.debug(f'stopping worker {self._node.name}')
+        proc.terminate()
+        try:
+            proc.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    def kill_command(self):
+        """
+        Return the pkill command for this worker app and port, or for an app started without a port.
+        The command waits for the app to exit, so that the port is free for the new app.
+        The '.' is matched with '[.]' so that the pattern does not match the shell running pkill.
+        """
+        app_name = re.escape(self._app_name).replace('\\.', '[.]')
+        pattern = shlex.quote(f'{app_name}( --port {self._port})?$')
+        return (f'pkill -f {pattern}; count=0; '
+            f'while pgrep -f {pattern} > /dev/null && [ $count -lt {KILL_WAIT_COUNT} ]; '
+            f'do sleep 0.1; count=$((count + 1)); done')
+
+    def wait_for_connection(self, proc, connection_timeout=CONNECTION_TIMEOUT, config=None):
+        """
+        Wait for the worker app to print the ready token, trying to connect with an
+        exponential backoff in between, in case the app does not print the token.
+        """
+        timeout = time.time() + connection_timeout
+        delay = CONNECTION_RETRY_DELAY
+        is_output = True
+        token = WORKER_READY_TOKEN.encode()
+        output = b''
+        logger.debug('waiting for connection')
+        while timeout > time.time():
+            wait_time = max(0, min(delay, timeout - time.time()))
+            if is_output:
+                ready_list, _, _ = select.select([proc.stdout], [], [], wait_time)
+                if ready_list:
+                    data = proc.stdout.read(OUTPUT_READ_SIZE)
+                    if not data:
+                        # ssh has closed, so only the backoff is left
+                        is_output = False
+                        continue
+                    output += data
+                    if token not in output:
+                        # keep the end, in case the token is split over two reads
+                        output = output[-len(token):]
+                        continue
+                    logger.debug(f'worker ready {self._node.hostname}')
+            else:
+                time.sleep(wait_time)
+            connection = self.connect(config)
+            if connection:
+                logger.debug('connected')
+                return connection
+            delay = min(delay * 2, CONNECTION_RETRY_MAX_DELAY)
+        return None
+
     @property
     def node(self):
         return self._node
@@ -90,5 +206,31 @@ class Worker:
     def port(self):
         return self._port
 
+    @property
+    def service_name(self):
+        return self._service_name
+
     def __str__(self):
         return f'{self._node}: {self._filename}:{self._port}'
+
+
+
+def startup_workers(worker_list, is_restart=False, connection_timeout=CONNECTION_TIMEOUT, config=None):
+    """
+    Startup all of the workers at the same time, and return a list of connections made with the
+    rpyc `config`, in the same order as `worker_list`, with None for a worker that cannot be started.
+    """
+    if not worker_list:
+        return []
+    manifests = {}
+    if is_restart:
+        # build the manifest of each worker path once, rather than on each of the sync threads at the same time
+        for worker in worker_list:
+            if not worker.node.is_local and worker.path not in manifests:
+                manifests[worker.path] = manifest_cache.build(worker.path)
+    with ThreadPoolExecutor(max_workers=len(worker_list)) as executor:
+        future_list = [
+            executor.submit(worker.startup, is_restart, connection_timeout, config, manifests.get(worker.path))
+            for worker in worker_list
+        ]
+        return [future.result() for future in future_list]
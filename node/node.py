@@ -5,35 +5,37 @@ import os
 import subprocess
 import yaml
 
-from multiprocessing import Process
-
 
 from cluster import (
     Cluster,
     Worker
 )
+from cluster.executor import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_TIMEOUT,
+    Executor
+)
+from cluster.manifest import manifest_cache
 
 DEFAULT_CONFIG_FILENAME = 'cluster.conf'
 
 COMMAND_LIST = ['exec', 'sync', 'poweroff']
 
-def node_command(cluster, node, command, params):
-
+def node_command_line(cluster, node, command, params, files_from=None):
     if command == 'exec':
-        if not params:
-            print('you need to pass a command to execute')
-            return
-        result = node.execute(params[0])
-        print(f'{node}: exec {params[0]}')
-        print(result)
+        return node.ssh_line(params[0])
     elif command == 'sync':
-        result = node.sync(cluster.worker_path)
-        print(f'{node}: rsync {cluster.worker_path}')
-        print(result)
+        return node.sync_line(cluster.worker_path, files_from)
     elif command == 'poweroff':
-        result = node.execute('sudo poweroff')
-        print(f'{node}: exec sudo poweroff')
-        print(result)
+        return node.ssh_line('sudo poweroff')
+
+def print_summary(result_list):
+    print()
+    print(f'{"node":20} {"time":>8} status')
+    for result in result_list:
+        print(f'{result.node.name:20} {result.latency:8.2f} {result.status}')
+    fail_count = len([result for result in result_list if not result.is_success])
+    print(f'{len(result_list) - fail_count} ok, {fail_count} failed')
 
 
 def main():
@@ -50,6 +52,21 @@ def main():
         help='number of nodes to operate on. Default: All nodes'
     )
 
+    parser.add_argument('-j', '--concurrency',
+        default=DEFAULT_CONCURRENCY,
+        help=f'number of nodes to run at the same time. Default: {DEFAULT_CONCURRENCY}'
+    )
+
+    parser.add_argument('-t', '--timeout',
+        default=DEFAULT_TIMEOUT,
+        help=f'seconds to wait for each node. Default: {DEFAULT_TIMEOUT}'
+    )
+
+    parser.add_argument('--force',
+        action='store_true',
+        help='sync all files even if the node already has them. Default: False'
+    )
+
     parser.add_argument('command',
         help='command to run for each node'
     )
@@ -73,21 +90,49 @@ def main():
     command = args.command.lower()
     if command not in COMMAND_LIST:
         print(f'unkown command "{args.command}"')
+        return
+
+    if command == 'exec' and not args.params:
+        print('you need to pass a command to execute')
+        return
+
+    manifest = None
+    if command == 'sync':
+        manifest = manifest_cache.build(cluster.worker_path)
 
-    proc_list = []
+    job_list = []
+    files_from_list = []
 
     for node in cluster.nodes:
         if node_count >= count and count > 0:
             break
         node_count += 1
-        command = args.command.lower()
-        proc = Process(target=node_command, args=(cluster, node, command, args.params))
-        proc_list.append(proc)
-        proc.start()
-
-
-    for proc in proc_list:
-        proc.join()
+        if command == 'poweroff' and node.is_local:
+            print(f'{node}: will not poweroff the local machine')
+            continue
+        files_from = None
+        if manifest and not args.force:
+            file_list = node.sync_files(cluster.worker_path, manifest)
+            if not file_list:
+                print(f'{node}: no changes to sync')
+                continue
+            files_from = node.write_files_from(cluster.worker_path, file_list)
+            files_from_list.append(files_from)
+        job_list.append((node, node_command_line(cluster, node, command, args.params, files_from)))
+
+    executor = Executor(int(args.concurrency), float(args.timeout))
+    try:
+        result_list = executor.run(job_list)
+    finally:
+        for files_from in files_from_list:
+            os.remove(files_from)
+
+    if manifest:
+        for result in result_list:
+            if result.is_success:
+                result.node.sync_done(cluster.worker_path, manifest)
+
+    print_summary(result_list)
 
 if __name__ == '__main__':
     main()
@@ -1,16 +1,21 @@
 #!/usr/bin/env  python3
 
+import argparse
 import cpuinfo
 import psutil
 import rpyc
+import sys
 import os
 import time
 
 from threading import Thread
 
+WORKER_READY_TOKEN = 'worker ready'
 NODE_STATS_PORT = 18880
 
 class NodeStats(rpyc.Service):
+    ALIASES = ['node_stats']
+
 
     def exposed_get_cpu(self):
         cpu_percent = psutil.cpu_percent(interval=None)
@@ -50,7 +55,25 @@ class NodeStats(rpyc.Service):
 
 def main():
     from rpyc.utils.server import ThreadedServer
-    server = ThreadedServer(NodeStats, port=NODE_STATS_PORT)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port',
+        type=int,
+        default=NODE_STATS_PORT,
+        help=f'Port to listen on. Default: {NODE_STATS_PORT}'
+    )
+    args = parser.parse_args()
+
+    server = ThreadedServer(NodeStats, port=args.port)
+    # listen before telling the controller that the server is ready
+    server._listen()
+    try:
+        print(WORKER_READY_TOKEN, flush=True)
+    except BrokenPipeError:
+        # the controller connected before it read the token, and has closed the pipe
+        pass
+    # nothing reads the output after this, so do not write to a closed pipe
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
     server.start()
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+from cluster.journal import Journal
+
+HEADER = {
+    'app': 'test',
+    'max': 100,
+    'seed': None,
+}
+
+
+@pytest.fixture
+def filename(tmp_path):
+    return os.path.join(str(tmp_path), 'test.journal')
+
+
+def write_journal(filename, header, record_list):
+    journal = Journal(filename, flush_interval=0)
+    journal.open(header)
+    for from_number, to_number, value in record_list:
+        journal.record((from_number, to_number), value)
+    journal.close()
+
+
+def resume_journal(filename, header=HEADER):
+    journal = Journal(filename, flush_interval=0)
+    try:
+        return journal.open(header, is_resume=True)
+    finally:
+        journal.close()
+
+
+def test_open_new(filename):
+    journal = Journal(filename, flush_interval=0)
+    header, done_ranges, done_value = journal.open(dict(HEADER, seed=7))
+    journal.close()
+    assert header['seed'] == 7
+    assert len(done_ranges) == 0
+    assert done_value == 0
+    assert Journal(filename).load_header() == dict(HEADER, seed=7)
+
+
+def test_open_resume(filename):
+    write_journal(filename, dict(HEADER, seed=7), [(0, 10, 3), (20, 30, 4), (10, 20, 5)])
+    journal = Journal(filename, flush_interval=0)
+    # a key of None is filled in from the journal
+    header, done_ranges, done_value = journal.open(HEADER, is_resume=True)
+    journal.record((40, 50), 6)
+    journal.close()
+    assert header['seed'] == 7
+    assert list(done_ranges) == [(0, 30)]
+    assert done_value == 12
+
+    header, done_ranges, done_value = resume_journal(filename)
+    assert list(done_ranges) == [(0, 30), (40, 50)]
+    assert done_value == 18
+
+
+def test_open_resume_refuses_a_different_job(filename):
+    write_journal(filename, dict(HEADER, seed=7), [(0, 10, 3)])
+    with pytest.raises(ValueError):
+        resume_journal(filename, dict(HEADER, max=200))
+    with pytest.raises(ValueError):
+        resume_journal(filename, dict(HEADER, seed=8))
+    with pytest.raises(ValueError):
+        resume_journal(filename, dict(HEADER, engine='other'))
+
+
+def test_open_resume_without_a_journal(filename):
+    with pytest.raises(ValueError):
+        resume_journal(filename)
+
+
+def test_resume_after_a_cut_short_line(filename):
+    write_journal(filename, dict(HEADER, seed=7), [(0, 10, 3)])
+    with open(filename, 'a') as fp:
+        fp.write('[10, 20,')
+    journal = Journal(filename, flush_interval=0)
+    header, done_ranges, done_value = journal.open(HEADER, is_resume=True)
+    journal.record((10, 20), 4)
+    journal.close()
+    assert list(done_ranges) == [(0, 10)]
+
+    header, done_ranges, done_value = resume_journal(filename)
+    assert list(done_ranges) == [(0, 20)]
+    assert done_value == 7
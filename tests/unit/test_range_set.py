@@ -0,0 +1,60 @@
+import random
+
+import pytest
+
+from cluster.scheduler import (
+    GapCursor,
+    RangeSet
+)
+
+
+def take_all(cursor, size):
+    items = set()
+    remaining = cursor.remaining
+    task = cursor.take(size)
+    while task is not None:
+        assert task[0] < task[1] <= task[0] + size
+        items.update(range(task[0], task[1]))
+        remaining -= task[1] - task[0]
+        assert cursor.remaining == remaining
+        task = cursor.take(size)
+    assert cursor.remaining == 0
+    return items
+
+
+def test_range_set_joins_ranges():
+    done_ranges = RangeSet()
+    done_ranges.add(10, 20)
+    done_ranges.add(30, 40)
+    done_ranges.add(20, 25)
+    done_ranges.add(5, 12)
+    done_ranges.add(50, 50)
+    assert list(done_ranges) == [(5, 25), (30, 40)]
+    assert done_ranges.size == 30
+    done_ranges.add(0, 100)
+    assert list(done_ranges) == [(0, 100)]
+    assert done_ranges.size == 100
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_gap_cursor_matches_set_difference(seed):
+    generator = random.Random(seed)
+    start = generator.randrange(0, 50)
+    stop = start + generator.randrange(0, 500)
+    done_ranges = RangeSet()
+    done_items = set()
+    for index in range(generator.randrange(0, 20)):
+        from_number = generator.randrange(0, stop + 50)
+        to_number = from_number + generator.randrange(0, 60)
+        done_ranges.add(from_number, to_number)
+        done_items.update(range(from_number, to_number))
+    assert done_ranges.size == len(done_items)
+
+    cursor = GapCursor(start, stop, done_ranges)
+    assert take_all(cursor, generator.randrange(1, 40)) == set(range(start, stop)) - done_items
+
+
+def test_gap_cursor_with_nothing_done():
+    cursor = GapCursor(0, 100, RangeSet())
+    assert cursor.take(30) == (0, 30)
+    assert take_all(cursor, 30) == set(range(30, 100))
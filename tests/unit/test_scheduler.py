@@ -0,0 +1,155 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from cluster import scheduler as scheduler_module
+from cluster.scheduler import (
+    MAX_FAIL_COUNT,
+    RangeCursor,
+    Scheduler
+)
+
+RANGE_STOP = 2000
+BLOCK_SIZE = 10
+JOIN_TIMEOUT = 30
+
+
+class FakeNode:
+
+    def __init__(self, name):
+        self.name = name
+        self.hostname = name
+
+
+class FakeWorker:
+    """
+    Worker that fails its first `fail_count` calls, or every call if `fail_count` is None.
+    """
+
+    def __init__(self, name, port, fail_count=0):
+        self.node = FakeNode(name)
+        self.port = port
+        self._fail_count = fail_count
+        self._lock = threading.Lock()
+        self.call_count = 0
+        self.error_count = 0
+
+    def run(self, task):
+        time.sleep(0.001)
+        with self._lock:
+            self.call_count += 1
+            if self._fail_count is None or self.call_count <= self._fail_count:
+                self.error_count += 1
+                raise EOFError(f'{self.node.name} failed')
+        return task[1] - task[0]
+
+
+class FakeConnection:
+
+    def __init__(self, worker):
+        self.worker = worker
+
+
+class FakeManager:
+
+    @contextmanager
+    def borrow(self, worker):
+        yield FakeConnection(worker)
+
+    def acquire(self, worker):
+        return FakeConnection(worker)
+
+    def release(self, worker, connection):
+        pass
+
+    def close(self, connection):
+        pass
+
+
+class FakeAsyncResult:
+
+    def __init__(self, worker, task):
+        self._worker = worker
+        self._task = task
+
+    @property
+    def value(self):
+        return self._worker.run(self._task)
+
+
+def call(connection, task):
+    return connection.worker.run(task)
+
+
+def call_async(connection, task):
+    return FakeAsyncResult(connection.worker, task)
+
+
+@pytest.fixture(autouse=True)
+def short_retry_delay(monkeypatch):
+    monkeypatch.setattr(scheduler_module, 'FAIL_RETRY_DELAY', 0.001)
+    monkeypatch.setattr(scheduler_module, 'FAIL_RETRY_MAX_DELAY', 0.01)
+
+
+def run_scheduler(worker_list, pipeline, slot_count=4, depth=2):
+    reduced = []
+    reduce_lock = threading.Lock()
+
+    def reduce(worker, task, result):
+        with reduce_lock:
+            reduced.append((worker.node.name, task, result))
+
+    scheduler = Scheduler(
+        FakeManager(),
+        call_async if pipeline else call,
+        reduce,
+        block_size=BLOCK_SIZE,
+        pipeline=pipeline
+    )
+    for worker in worker_list:
+        # start below the slot count as the apps do, so that some of the slots wait for a turn
+        scheduler.add_worker(worker, slot_count, min(depth, slot_count))
+    scheduler.start(RangeCursor(0, RANGE_STOP))
+    assert scheduler.join(JOIN_TIMEOUT), 'scheduler did not finish'
+    return scheduler, reduced
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_flaky_worker(pipeline):
+    worker_list = [FakeWorker('good', 1), FakeWorker('flaky', 2, fail_count=3)]
+    scheduler, reduced = run_scheduler(worker_list, pipeline)
+
+    task_list = sorted(task for name, task, result in reduced)
+    # each block is reduced once, and together the blocks cover the range
+    assert len(task_list) == len(set(task_list))
+    assert sum(result for name, task, result in reduced) == RANGE_STOP
+    assert task_list[0][0] == 0 and task_list[-1][1] == RANGE_STOP
+    for (from_number, to_number), (next_from, next_to) in zip(task_list, task_list[1:]):
+        assert to_number == next_from
+    assert scheduler.done_size == RANGE_STOP
+    assert scheduler.pending_count == 0
+    assert worker_list[1].error_count == 3
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_failing_worker_is_dropped(pipeline):
+    worker_list = [FakeWorker('good', 1), FakeWorker('broken', 2, fail_count=None)]
+    # one slot, or a depth of one, so that each failure is one call
+    scheduler, reduced = run_scheduler(worker_list, pipeline, slot_count=1)
+
+    assert worker_list[1].error_count == MAX_FAIL_COUNT
+    assert all(name == 'good' for name, task, result in reduced)
+    assert sum(result for name, task, result in reduced) == RANGE_STOP
+    assert scheduler.done_size == RANGE_STOP
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_all_workers_failing_finishes(pipeline):
+    worker_list = [FakeWorker('broken1', 1, fail_count=None), FakeWorker('broken2', 2, fail_count=None)]
+    scheduler, reduced = run_scheduler(worker_list, pipeline)
+
+    assert reduced == []
+    assert scheduler.done_size == 0
+    assert scheduler.pending_count > 0
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+WORKER_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'apps', 'primeCalculator', 'worker')
+sys.path.insert(0, os.path.abspath(WORKER_PATH))
+
+from prime_calculate import (  # noqa: E402
+    SEGMENT_SIZE,
+    BasePrimeCache,
+    base_primes,
+    is_prime,
+    sieve_count,
+    sieve_prime
+)
+
+RANGE_LIST = [
+    (0, 0),
+    (0, 1),
+    (0, 2),
+    (0, 3),
+    (0, 1000),
+    (1, 2),
+    (2, 3),
+    (3, 4),
+    (4, 5),
+    (17, 18),
+    (990, 1010),
+    (1000, 5000),
+    # over more than one segment, and starting and ending on odd and even numbers
+    (SEGMENT_SIZE * 2 - 11, SEGMENT_SIZE * 6 + 7),
+    (1000000, 1000000 + SEGMENT_SIZE * 2),
+    (2 ** 32 - 1000, 2 ** 32 + 1000),
+]
+
+
+@pytest.mark.parametrize('from_number, to_number', RANGE_LIST)
+def test_sieve_prime_matches_is_prime(from_number, to_number):
+    expected = [number for number in range(from_number, to_number) if is_prime(number)]
+    assert sieve_prime(from_number, to_number) == expected
+    assert sieve_count(from_number, to_number) == len(expected)
+
+
+def test_base_primes():
+    assert base_primes(2) == []
+    assert base_primes(3) == [3]
+    assert base_primes(1000) == [number for number in range(3, 1001) if is_prime(number)]
+
+
+def test_base_prime_cache_extends():
+    cache = BasePrimeCache(max_limit=10000)
+    assert list(cache.primes(100)) == base_primes(100)
+    primes = list(cache.primes(5000))
+    assert primes[:len(base_primes(5000))] == base_primes(5000)
+    assert cache.limit >= 5000
+    assert cache.primes(50) is cache.primes(5000)
+    # past the most to keep, the primes are found each time
+    assert cache.primes(20000) == base_primes(20000)
+    assert cache.limit <= 10000